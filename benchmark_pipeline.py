@@ -0,0 +1,460 @@
+#!/usr/bin/python3
+# Benchmarks convert_and_generate_prs.py end to end without Wavefront, GitHub Enterprise or the real converters.
+# For every artifact type and inventory size it:
+# 1. Generates a synthetic inventory csv with the column layout process_csv expects.
+# 2. Sets up a bare git remote with a clone of it as the migration repo, stub converters and a fake gh
+#    (or with --github_api, a stand-in GitHub api).
+# 3. Serves synthetic artifacts from a local http server.
+# 4. Runs the pipeline and reports per-stage throughput, latency percentiles and peak RSS.
+
+import argparse
+import csv
+import hashlib
+import http.server
+import json
+import logging
+import os
+import random
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+
+logger = logging.getLogger()
+streamHandler = logging.StreamHandler(sys.stdout)
+streamHandler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s'))
+logger.addHandler(streamHandler)
+logger.setLevel(logging.INFO)
+
+pipeline_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'convert_and_generate_prs.py')
+
+# Columns of the inventory csvs, see iter_csv.
+csv_layouts = {
+    'dashboard': {'num_columns': 18, 'link': 5, 'to_be_converted': 8, 'skip_generation': 10, 'namespace': 11,
+                  'reviewer': 12, 'service_team': None, 'not_yet_created': 17},
+    'alert': {'num_columns': 23, 'link': 8, 'to_be_converted': 11, 'skip_generation': 13, 'namespace': 14,
+              'reviewer': 16, 'service_team': 15, 'not_yet_created': 22},
+}
+
+# Stub converter: writes the files get_filenames expects next to the input and logs its start/end time.
+stub_converter = '''#!%(python)s -SE
+import sys, time, json, os
+start = time.time()
+args = sys.argv[1:]
+input_file = args[args.index('-f') + 1]
+base = input_file[:-len('.json')]
+dirname, name = os.path.split(base)
+with open(input_file) as f:
+    artifact = json.load(f)
+time.sleep(%(latency)f)
+outputs = %(outputs)r
+for suffix, contents in outputs:
+    out = os.path.join(dirname, suffix %% name)
+    with open(out, 'w') as f:
+        f.write(contents if contents is not None else json.dumps(artifact))
+with open(%(events)r, 'a') as f:
+    f.write('%%f %%f\\n' %% (start, time.time()))
+'''
+
+converter_outputs = {
+    'dashboard': [('%s_orig.json', None), ('%s_wf_prom.json', None), ('%s_grafana.json', '{"panels": []}'),
+                  ('%s_summary.json', '{}'), ('wavefront_dashboard_link_%s.txt', 'link\n')],
+    'alert': [('%s_orig.json', None), ('%s_pharos.yaml', 'groups: []\n'), ('%s_pharos_report.json', '{}')],
+}
+
+# Fake gh: one file per PR'd branch under the state directory ('/' in branch names as %2F), enough for pr
+# create/list/edit and the PR listing api.
+fake_gh = '''#!%(python)s -SE
+import sys, time, os, fcntl
+start = time.time()
+state = %(state)r
+args = sys.argv[1:]
+def opt(name):
+    return args[args.index(name) + 1] if name in args else None
+time.sleep(%(latency)f)
+if args[:2] == ['pr', 'create']:
+    with open(os.path.join(state, 'counter'), 'a+') as counter:
+        fcntl.flock(counter, fcntl.LOCK_EX)
+        counter.seek(0)
+        number = int(counter.read() or 0) + 1
+        counter.seek(0)
+        counter.truncate()
+        counter.write(str(number))
+    with open(os.path.join(state, 'prs', opt('--head').replace('/', '%%2F')), 'w') as pr:
+        pr.write('%%d open' %% number)
+    print('https://ghe.example.com/wavefront-migration/bench/pull/%%d' %% number)
+elif args[:2] == ['pr', 'list']:
+    pr_file = os.path.join(state, 'prs', opt('--head').replace('/', '%%2F'))
+    if os.path.exists(pr_file):
+        number, pr_state = open(pr_file).read().split()
+        if (pr_state == 'closed') == (opt('-s') == 'closed'):
+            print('%%s\\ttitle\\t%%s\\t%%s' %% (number, opt('--head'), pr_state.upper()))
+elif args[0] == 'api':
+    for head in os.listdir(os.path.join(state, 'prs')):
+        number, pr_state = open(os.path.join(state, 'prs', head)).read().split()
+        print('%%s\\t%%s\\t%%s' %% (number, head.replace('%%2F', '/'), pr_state))
+with open(%(events)r, 'a') as f:
+    f.write('%%f %%f\\n' %% (start, time.time()))
+'''
+
+def generate_artifact(artifact_type, artifact_id, charts):
+    '''
+    A Wavefront api response for the artifact, of a size that varies with artifact_id.
+    '''
+    rand = random.Random(artifact_id)
+    if artifact_type == 'dashboard':
+        rows = []
+        for i in range(rand.randint(1, 2 * charts)):
+            rows.append({'charts': [{'name': 'chart %d' % i,
+                                     'sources': [{'name': 'q', 'query': 'ts("%s.metric.%d", env=prod) * %d' % (artifact_id, i, rand.randint(1, 100))}]}]})
+        response = {'id': artifact_id, 'name': 'dashboard %s' % artifact_id, 'sections': [{'name': 'section', 'rows': rows}],
+                    'updatedEpochMillis': 1700000000000}
+    else:
+        response = {'id': artifact_id, 'name': 'alert %s' % artifact_id, 'condition': 'ts("%s.metric") > %d' % (artifact_id, rand.randint(1, 100)),
+                    'target': 'target:abc', 'updatedEpochMillis': 1700000000000}
+    return json.dumps({'status': {'result': 'OK', 'message': '', 'code': 200}, 'response': response}).encode('utf-8')
+
+def generate_inventory(filename, artifact_type, num_rows, num_namespaces, duplicate_ratio, seed=0):
+    '''
+    Writes a csv of num_rows artifacts to be converted; duplicate_ratio of the rows repeat an earlier artifact in another namespace.
+    '''
+    rand = random.Random(seed)
+    layout = csv_layouts[artifact_type]
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['column %d' % i for i in range(layout['num_columns'])])
+        artifact_ids = []
+        for i in range(num_rows):
+            if len(artifact_ids) > 0 and rand.random() < duplicate_ratio:
+                artifact_id = rand.choice(artifact_ids)
+            else:
+                artifact_id = 'bench%s%06d' % (artifact_type, i)
+                artifact_ids.append(artifact_id)
+            row = [''] * layout['num_columns']
+            row[layout['link']] = 'https://wavefront.example.com/%ss/%s' % (artifact_type, artifact_id)
+            row[layout['to_be_converted']] = 'TRUE'
+            row[layout['skip_generation']] = 'FALSE'
+            row[layout['namespace']] = 'ns%d' % rand.randrange(num_namespaces)
+            row[layout['reviewer']] = 'reviewer%d' % rand.randrange(10)
+            if layout['service_team'] is not None:
+                row[layout['service_team']] = 'team%d' % rand.randrange(5)
+            row[layout['not_yet_created']] = 'Not Created'
+            writer.writerow(row)
+
+class ArtifactServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, charts, latency):
+        super().__init__(('127.0.0.1', 0), ArtifactHandler)
+        self.charts = charts
+        self.latency = latency
+        self.events = []
+        self.events_lock = threading.Lock()
+
+class ArtifactHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        start = time.time()
+        artifact_type, artifact_id = self.path.strip('/').split('/')[-2:]
+        body = generate_artifact(artifact_type, artifact_id, self.server.charts)
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        time.sleep(self.server.latency)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        with self.server.events_lock:
+            self.server.events.append((start, time.time()))
+
+    def log_message(self, *args):
+        pass
+
+class GitHubApiServer(http.server.ThreadingHTTPServer):
+    '''
+    Stand-in for the GitHub REST api (--github_api): the PR calls create_pr_if_needed_api makes, keeping its PRs
+    in the same state directory as the fake gh.
+    '''
+    daemon_threads = True
+
+    def __init__(self, state, latency):
+        super().__init__(('127.0.0.1', 0), GitHubApiHandler)
+        self.state = state
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.events = []
+
+class GitHubApiHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    page_size = 100
+
+    def reply(self, status, body, next_page=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if next_page is not None:
+            self.send_header('Link', '<http://%s:%d%s>; rel="next"' % (self.server.server_address + (next_page,)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def pulls(self):
+        prs_dir = os.path.join(self.server.state, 'prs')
+        prs = []
+        for head in os.listdir(prs_dir):
+            number, pr_state = open(os.path.join(prs_dir, head)).read().split()
+            prs.append({'number': int(number), 'state': pr_state, 'head': {'ref': head.replace('%2F', '/')},
+                        'html_url': 'https://ghe.example.com/wavefront-migration/bench/pull/%s' % number})
+        return sorted(prs, key=lambda pr: pr['number'])
+
+    def handle_request(self):
+        start = time.time()
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = json.loads(self.rfile.read(length)) if length != 0 else None
+        time.sleep(self.server.latency)
+        if self.headers.get('Authorization') is None:
+            self.reply(401, {'message': 'Requires authentication'})
+        elif parts[-1] == 'pulls' and self.command == 'GET':
+            prs = self.pulls()
+            if 'head' in query:
+                prs = [pr for pr in prs if pr['head']['ref'] == query['head'][0].split(':', 1)[-1]]
+            page = int(query.get('page', ['1'])[0])
+            next_page = None
+            if page * self.page_size < len(prs):
+                next_page = '%s?%s' % (url.path, urllib.parse.urlencode(dict(query, page=page + 1), doseq=True))
+            self.reply(200, prs[(page - 1) * self.page_size:page * self.page_size], next_page=next_page)
+        elif parts[-1] == 'pulls' and self.command == 'POST':
+            with self.server.lock:
+                number = len(self.pulls()) + 1
+                with open(os.path.join(self.server.state, 'prs', payload['head'].replace('/', '%2F')), 'w') as pr:
+                    pr.write('%d open' % number)
+            self.reply(201, {'number': number, 'html_url': 'https://ghe.example.com/wavefront-migration/bench/pull/%d' % number})
+        elif parts[-1] == 'graphql':
+            # User lookups (see resolve_github_users); logins starting with 'invalid' don't exist.
+            users = re.findall(r'(u\d+): user\(login: "([^"]*)"\)', payload['query'])
+            data = {alias: {'login': login} if not login.startswith('invalid') else None for alias, login in users}
+            errors = [{'type': 'NOT_FOUND', 'path': [alias]} for alias, login in users if data[alias] is None]
+            self.reply(200, dict({'data': data}, **({'errors': errors} if errors else {})))
+        else:
+            # Edits and reviewer requests only need to succeed.
+            self.reply(200, {})
+        with self.server.lock:
+            self.server.events.append((start, time.time()))
+
+    do_GET = do_POST = do_PATCH = do_DELETE = handle_request
+
+    def log_message(self, *args):
+        pass
+
+def run(cmd, cwd=None):
+    return subprocess.run(cmd, check=True, cwd=cwd, capture_output=True)
+
+def setup_work_dir(work_dir, artifact_type, args):
+    '''
+    Lays out work_dir like a migration checkout: migration/ (cloned from origin.git) next to conversions-binary/,
+    plus bin/ with the fake gh and events/ where the stand-ins log their timings.
+    '''
+    for d in ['bin', 'conversions-binary', 'events', 'gh-state/prs']:
+        os.makedirs(os.path.join(work_dir, d), exist_ok=True)
+    origin = os.path.join(work_dir, 'origin.git')
+    migration = os.path.join(work_dir, 'migration')
+    run(['git', 'init', '-q', '--bare', '-b', 'main', origin])
+    run(['git', 'clone', '-q', origin, migration])
+    for key, value in [('user.email', 'bench@example.com'), ('user.name', 'bench'), ('gc.auto', '0')]:
+        run(['git', 'config', key, value], cwd=migration)
+    with open(os.path.join(migration, 'README.md'), 'w') as readme:
+        readme.write('benchmark\n')
+    run(['git', 'add', 'README.md'], cwd=migration)
+    run(['git', 'commit', '-q', '-m', 'init'], cwd=migration)
+    run(['git', 'push', '-q', 'origin', 'main'], cwd=migration)
+    converters_dir = os.path.join(work_dir, 'conversions-binary')
+    for filename in ['conversion_settings.yaml', 'notificants.json']:
+        open(os.path.join(converters_dir, filename), 'w').close()
+    scripts = {
+        os.path.join(converters_dir, '%s_converter' % artifact_type): stub_converter % {
+            'python': sys.executable, 'latency': args.converter_latency, 'outputs': converter_outputs[artifact_type],
+            'events': os.path.join(work_dir, 'events', 'convert')},
+        os.path.join(work_dir, 'bin', 'gh'): fake_gh % {
+            'python': sys.executable, 'latency': args.gh_latency, 'state': os.path.join(work_dir, 'gh-state'),
+            'events': os.path.join(work_dir, 'events', 'gh')},
+    }
+    for filename, contents in scripts.items():
+        with open(filename, 'w') as script:
+            script.write(contents)
+        os.chmod(filename, 0o755)
+    return migration
+
+def read_events(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return [tuple(float(t) for t in line.split()) for line in f if line.strip() != '']
+
+def percentile(values, p):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+def summarize(events):
+    '''
+    Throughput and latency percentiles of (start, end) events.
+    '''
+    if len(events) == 0:
+        return {'count': 0}
+    latencies = [end - start for start, end in events]
+    wall = max(end for _, end in events) - min(start for start, _ in events)
+    return {'count': len(events), 'wall_s': wall, 'per_s': len(events) / wall if wall > 0 else None,
+            'p50_ms': percentile(latencies, 50) * 1000, 'p90_ms': percentile(latencies, 90) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000, 'max_ms': max(latencies) * 1000}
+
+artifact_log_re = re.compile(r'^(\S+ \S+) \S+\s+(\d+): (.*)')
+
+def read_artifact_latencies(log_file):
+    '''
+    Per artifact time from create_prs picking it up ("<i>: working with") to its PR being recorded ("<i>: validReviewers").
+    '''
+    started = {}
+    events = []
+    with open(log_file, errors='replace') as log:
+        for line in log:
+            m = artifact_log_re.match(line)
+            if m is None:
+                continue
+            timestamp = datetime.strptime(m.group(1), '%Y-%m-%d %H:%M:%S,%f').timestamp()
+            index, message = m.group(2), m.group(3)
+            if message.startswith('working with'):
+                started[index] = timestamp
+            elif message.startswith('validReviewers') and index in started:
+                events.append((started.pop(index), timestamp))
+    return events
+
+def run_benchmark(artifact_type, num_rows, args):
+    work_dir = tempfile.mkdtemp(prefix='kf-bench-%s-%d-' % (artifact_type, num_rows), dir=args.work_dir)
+    migration = setup_work_dir(work_dir, artifact_type, args)
+    inventory = os.path.join(work_dir, 'inventory.csv')
+    generate_inventory(inventory, artifact_type, num_rows, args.namespaces, args.duplicate_ratio)
+    server = ArtifactServer(args.charts, args.download_latency)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    cmd = [sys.executable, pipeline_script, '--artifact_type', artifact_type, '--input_file', inventory,
+           '--artifact_download_url', 'http://127.0.0.1:%d/%%s/%%s' % server.server_address[1], '--bearer', 'bench']
+    cmd += get_pipeline_args(args)
+    env = dict(os.environ, PATH='%s:%s' % (os.path.join(work_dir, 'bin'), os.environ.get('PATH', '')))
+    github_server = None
+    if args.github_api:
+        github_server = GitHubApiServer(os.path.join(work_dir, 'gh-state'), args.gh_latency)
+        threading.Thread(target=github_server.serve_forever, daemon=True).start()
+        cmd += ['--github_api_url', 'http://127.0.0.1:%d/api/v3' % github_server.server_address[1], '--github_repo', 'wavefront-migration/bench']
+        env['GH_TOKEN'] = 'bench'
+    log_file = os.path.join(work_dir, 'pipeline.log')
+    logger.info("running %s rows of %ss in %s: %s", num_rows, artifact_type, work_dir, ' '.join(cmd))
+    start = time.time()
+    with open(log_file, 'w') as log:
+        proc = subprocess.Popen(cmd, cwd=migration, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 rather than wait, for the pipeline's resource usage.
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.time() - start
+    for stand_in in [server, github_server]:
+        if stand_in is not None:
+            stand_in.shutdown()
+            stand_in.server_close()
+    num_prs = len(os.listdir(os.path.join(work_dir, 'gh-state', 'prs')))
+    result = {
+        'artifact_type': artifact_type,
+        'rows': num_rows,
+        'pipeline_args': shlex.join(get_pipeline_args(args)),
+        'returncode': proc.returncode,
+        'wall_s': wall,
+        'rows_per_s': num_rows / wall if wall > 0 else None,
+        'prs': num_prs,
+        'peak_rss_mb': rusage.ru_maxrss / 1024.0,
+        'stages': {
+            'download': summarize(server.events),
+            'convert': summarize(read_events(os.path.join(work_dir, 'events', 'convert'))),
+            'gh': summarize(read_events(os.path.join(work_dir, 'events', 'gh'))),
+            'github': summarize(github_server.events if github_server is not None else []),
+            'artifact': summarize(read_artifact_latencies(log_file)),
+        },
+        'work_dir': work_dir,
+    }
+    if proc.returncode != 0:
+        logger.error("pipeline failed (returncode: %d), see %s", proc.returncode, log_file)
+    if not args.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        result['work_dir'] = None
+    return result
+
+def format_ms(value):
+    return '%9.1f' % value if value is not None else '%9s' % '-'
+
+def report(result):
+    logger.info("%ss: %d rows in %.1fs (%.1f rows/s), %d PRs, peak RSS %.1f MB, returncode %d",
+                result['artifact_type'], result['rows'], result['wall_s'], result['rows_per_s'], result['prs'],
+                result['peak_rss_mb'], result['returncode'])
+    logger.info("  %-9s %7s %9s %9s %9s %9s %9s %9s", 'stage', 'count', 'wall s', 'per s', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+    for stage, stats in result['stages'].items():
+        if stats['count'] == 0:
+            logger.info("  %-9s %7d", stage, 0)
+            continue
+        logger.info("  %-9s %7d %9.2f %s %s %s %s %s", stage, stats['count'], stats['wall_s'], format_ms(stats['per_s']),
+                    format_ms(stats['p50_ms']), format_ms(stats['p90_ms']), format_ms(stats['p99_ms']), format_ms(stats['max_ms']))
+
+def get_pipeline_args(args):
+    '''
+    The extra arguments for the pipeline: those of --pipeline_args followed by the ones after '--'.
+    '''
+    extra = args.extra_pipeline_args
+    if extra[:1] == ['--']:
+        extra = extra[1:]
+    return shlex.split(args.pipeline_args) + extra
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark convert_and_generate_prs.py against local stand-ins")
+    parser.add_argument('--sizes', default='100,1000', help="comma separated inventory sizes (rows) to benchmark, e.g. 100,1000,10000,50000")
+    parser.add_argument('--artifact_types', default='dashboard,alert', help="comma separated artifact types to benchmark")
+    parser.add_argument('--pipeline_args', default='', help="extra arguments for convert_and_generate_prs.py, e.g. '--streaming --publish_workers 4'; a single flag has to be given as --pipeline_args=--streaming, or pass the arguments after '--' instead")
+    parser.add_argument('--namespaces', default=20, type=int, help="number of namespaces the artifacts are spread over")
+    parser.add_argument('--duplicate_ratio', default=0.02, type=float, help="fraction of rows repeating an artifact in another namespace")
+    parser.add_argument('--charts', default=20, type=int, help="average number of charts per synthetic dashboard")
+    parser.add_argument('--download_latency', default=0.0, type=float, help="seconds the artifact server takes per request")
+    parser.add_argument('--converter_latency', default=0.0, type=float, help="seconds the stub converter takes per artifact")
+    parser.add_argument('--gh_latency', default=0.0, type=float, help="seconds the fake gh takes per call")
+    parser.add_argument('--github_api', default=False, action="store_true", help="have the pipeline create PRs through a stand-in GitHub api (--github_api_url) rather than the fake gh")
+    parser.add_argument('--work_dir', default=None, help="where the benchmark directories are created (default: the system temp dir)")
+    parser.add_argument('--keep', default=False, action="store_true", help="keep the benchmark directories")
+    parser.add_argument('--output', default=None, help="also write the results as json to this file")
+    parser.add_argument('extra_pipeline_args', nargs=argparse.REMAINDER, help="after '--', more arguments for convert_and_generate_prs.py, e.g. -- --streaming")
+    args = parser.parse_args()
+    results = []
+    for artifact_type in args.artifact_types.split(','):
+        for num_rows in [int(size) for size in args.sizes.split(',')]:
+            result = run_benchmark(artifact_type, num_rows, args)
+            report(result)
+            results.append(result)
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=1)
+    if any(result['returncode'] != 0 for result in results):
+        exit(-1)
+
+if __name__ == "__main__":
+    main()
@@ -7,15 +7,42 @@
 # 5. generate PRs.
 
 import argparse
+import atexit
+import contextlib
+import cProfile
 import csv
+import pstats
 import subprocess
 import os
 import sys
 import traceback
 from pprint import PrettyPrinter
 import logging
+import logging.handlers
 import glob
 import json
+import re
+import http.client
+import threading
+import time
+import urllib.parse
+import fnmatch
+import functools
+import hashlib
+import heapq
+import bisect
+import random
+import sqlite3
+import queue
+import shutil
+import tempfile
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import yaml
+except ImportError:
+    # Only needed to validate the converter config (--compile_config).
+    yaml = None
 pp = PrettyPrinter()
 
 logger = logging.getLogger()
@@ -28,16 +55,145 @@ fileHandler.setFormatter(formatter)
 logger.addHandler(streamHandler)
 logger.addHandler(fileHandler)
 logger.setLevel(logging.DEBUG)
+# iter_csv's per row messages, which are attributed to the parse stage wherever the csv is read (see StageLogFilter).
+csv_logger = logging.LoggerAdapter(logger, {'stages': ('parse',)})
+
+class lazy_pformat:
+    '''
+    Pretty prints obj only when the message it's an argument of is emitted.
+    '''
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return pp.pformat(self.obj)
+
+class StageLogFilter(logging.Filter):
+    '''
+    Applies --stage_log_level: a record is kept if it's at or above the level of the innermost stage (see span())
+    it was logged in that has one, or else the --log_level. Also tags records with their stage, artifact and namespace,
+    which are only known in the thread logging them.
+    '''
+    def __init__(self, level, stage_levels):
+        super().__init__()
+        self.level = level
+        self.stage_levels = stage_levels
+
+    def filter(self, record):
+        stages = getattr(record, 'stages', None) or getattr(_span_local, 'stages', ())
+        level = self.level
+        for stage in reversed(stages):
+            if stage in self.stage_levels:
+                level = self.stage_levels[stage]
+                break
+        if record.levelno < level:
+            return False
+        record.stage = stages[-1] if len(stages) != 0 else None
+        record.artifact, record.namespace = getattr(_span_local, 'tags', (None, None))
+        return True
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Hands records to the --async_logging listener thread, which formats them. Records with mutable arguments
+    are formatted here, as their arguments may change before the listener gets to them.
+    '''
+    immutable_types = (str, int, float, bool, type(None))
+
+    def prepare(self, record):
+        if record.args and not (isinstance(record.args, tuple) and all(isinstance(a, self.immutable_types) for a in record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class JsonlFormatter(logging.Formatter):
+    '''
+    One json object per record, for --log_format jsonl.
+    '''
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname, 'thread': record.threadName,
+                 'stage': getattr(record, 'stage', None), 'artifact': getattr(record, 'artifact', None),
+                 'namespace': getattr(record, 'namespace', None), 'message': record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+log_level_names = ['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG']
+
+def setup_logging(args):
+    '''
+    Replaces the default handlers according to the logging flags: the log file's format and rotation, the levels
+    per stage, and with --async_logging a queue so that the stages don't wait for the log to be written.
+    '''
+    level = logging.getLevelName(args.log_level.upper())
+    stage_levels = {}
+    for stage_level in args.stage_log_level or []:
+        stage, _, stage_level_name = stage_level.rpartition('=')
+        if stage == '' or stage_level_name.upper() not in log_level_names:
+            logger.error("--stage_log_level takes <stage>=<level> with level one of %s, not %s", ', '.join(log_level_names), stage_level)
+            exit(-1)
+        stage_levels[stage] = logging.getLevelName(stage_level_name.upper())
+    file_formatter = JsonlFormatter() if args.log_format == 'jsonl' else formatter
+    if args.log_max_bytes > 0:
+        log_file_handler = logging.handlers.RotatingFileHandler(args.log_file, maxBytes=args.log_max_bytes, backupCount=args.log_backup_count)
+    else:
+        log_file_handler = logging.FileHandler(args.log_file, mode='a')
+    log_file_handler.setFormatter(file_formatter)
+    handlers = [streamHandler, log_file_handler]
+    logger.removeHandler(fileHandler)
+    fileHandler.close()
+    logger.removeHandler(streamHandler)
+    stage_filter = StageLogFilter(level, stage_levels)
+    if args.async_logging:
+        log_queue = queue.SimpleQueue()
+        queue_handler = LazyQueueHandler(log_queue)
+        queue_handler.addFilter(stage_filter)
+        logger.addHandler(queue_handler)
+        listener = logging.handlers.QueueListener(log_queue, *handlers)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        for handler in handlers:
+            handler.addFilter(stage_filter)
+            logger.addHandler(handler)
+    # Messages below every level in effect aren't even created.
+    logger.setLevel(min([level] + list(stage_levels.values())))
 
 invalidReviewers = {}
 invalidReviewer = 0
 invalidArtifactFiles = {}
+# Guards the summary globals above when publishing with several workers.
+summary_lock = threading.Lock()
+remote_ref_lock = threading.Lock()
+# origin/main as fetched at the start of a --bulk_push run; artifact branches are rebased onto it.
+bulk_push_base = None
+# Head branch name -> {'number', 'state'} of the migration repo's PRs, when --use_pr_index is on.
+pr_index = None
+# sqlite connection of the --journal, recording which stages each artifact has completed.
+journal = None
+journal_lock = threading.Lock()
 g_args = None
 toplevel_dir = os.path.join(os.getcwd())
 logger.info(toplevel_dir)
-artifact_download_cmd_str = "curl '%s' -H 'Authorization: Bearer %s' | jq > \"%s\""
+# Statuses on which an artifact download is retried with backoff.
+artifact_download_retry_statuses = (429, 500, 502, 503, 504)
+artifact_download_chunk_size = 64 * 1024
+# download_artifact results, both are truthy. unchanged means dest was left as it was.
+download_written = 'written'
+download_unchanged = 'unchanged'
+# ETag/Last-Modified and content hash of each downloaded artifact, keyed by url.
+download_validators_filename = '.kf_download_validators.json'
+_download_validators = None
+_download_validators_lock = threading.Lock()
 converter_abs_dir = os.path.join(os.path.abspath(toplevel_dir), os.path.pardir, 'conversions-binary')
 logger.info(converter_abs_dir)
+# Files written by the converters (and renamed by this script); never used as converter input.
+converter_output_suffixes = ('_orig.json', '_prom.json', '_grafana.json', '_summary.json',
+                             '_cortex_report.json', '_pharos_report.json')
 
 db_pr_body = '''This PR contains dashboard artifacts generated for migration from Wavefront to Pharos.
 Steps to follow:
@@ -71,20 +227,426 @@ Files in this PR:
 • alertid_orig.json - Original Wavefront alert.
 • alertid_pharos_report.json - Report of conversion including failure descriptions.'''
 
-def run(cmd, dryrun=False, check=True, shell=True, capture_output=False, timeout=None, *args):
+# Timings of the stages and commands, see span(). They are aggregated as they are recorded, so that memory doesn't
+# grow with the number of artifacts, and reported at the end of the run (see report_timings).
+timing_stages = {}
+timing_namespaces = {}
+timing_spans_lock = threading.Lock()
+_span_local = threading.local()
+timing_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Per stage, the percentiles are computed from a uniform sample of at most this many durations (exact below it)
+# and the slowest spans of artifacts are kept.
+timing_sample_size = 4096
+timing_num_slowest = 10
+_timing_seq = 0
+
+def record_span(stage, artifact, namespace, duration, ok):
+    global _timing_seq
+    with timing_spans_lock:
+        stats = timing_stages.get(stage)
+        if stats is None:
+            stats = timing_stages[stage] = {'count': 0, 'failures': 0, 'sum': 0.0, 'max': 0.0,
+                                            'buckets': [0] * len(timing_buckets), 'sample': [], 'slowest': []}
+        stats['count'] += 1
+        stats['failures'] += 0 if ok else 1
+        stats['sum'] += duration
+        stats['max'] = max(stats['max'], duration)
+        bucket = bisect.bisect_left(timing_buckets, duration)
+        if bucket < len(timing_buckets):
+            stats['buckets'][bucket] += 1
+        # Reservoir sampling: every duration of the stage is in the sample with the same probability.
+        if len(stats['sample']) < timing_sample_size:
+            stats['sample'].append(duration)
+        else:
+            i = random.randrange(stats['count'])
+            if i < timing_sample_size:
+                stats['sample'][i] = duration
+        if artifact is not None:
+            _timing_seq += 1
+            slowest = (duration, _timing_seq, artifact, namespace)
+            if len(stats['slowest']) < timing_num_slowest:
+                heapq.heappush(stats['slowest'], slowest)
+            elif slowest > stats['slowest'][0]:
+                heapq.heapreplace(stats['slowest'], slowest)
+        if namespace is not None and not stage.startswith('exec:'):
+            namespace_stages = timing_namespaces.setdefault(namespace, {})
+            namespace_stages[stage] = namespace_stages.get(stage, 0) + duration
+
+@contextlib.contextmanager
+def span(stage, artifact=None, namespace=None):
+    '''
+    Times the enclosed block as stage. Spans started within it (e.g. for the commands run) inherit its artifact and namespace.
+    '''
+    parent = getattr(_span_local, 'tags', (None, None))
+    parent_stages = getattr(_span_local, 'stages', ())
+    tags = (artifact if artifact is not None else parent[0], namespace if namespace is not None else parent[1])
+    _span_local.tags = tags
+    _span_local.stages = parent_stages + (stage,)
+    start = time.time()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        duration = time.time() - start
+        _span_local.tags = parent
+        _span_local.stages = parent_stages
+        record_span(stage, tags[0], tags[1], duration, ok)
+
+def timed(stage, tags=None):
+    '''
+    Decorator timing every call as a span of stage. tags gets the call's arguments and returns its (artifact, namespace).
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            artifact, namespace = tags(*args, **kwargs) if tags is not None else (None, None)
+            with span(stage, artifact=artifact, namespace=namespace):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def path_tags(path, *args, **kwargs):
+    '''
+    (artifact, namespace) of an artifact file in a namespace directory.
+    '''
+    parts = os.path.relpath(os.path.abspath(path), toplevel_dir).split(os.sep)
+    namespace = parts[0] if len(parts) > 1 and parts[0] != os.path.pardir else None
+    return os.path.splitext(parts[-1])[0], namespace
+
+def item_tags(item, *args, **kwargs):
+    return item['dbname'], item['namespace']
+
+def get_command_stage(cmd):
+    words = ' '.join(cmd).split()
+    if len(words) == 0:
+        return 'exec'
+    name = os.path.basename(words[0])
+    if name.endswith('_converter'):
+        return 'exec:converter'
+    if name in ['git', 'gh']:
+        return 'exec:%s' % ' '.join([name] + [w for w in words[1:3] if not w.startswith('-')][:1 if name == 'git' else 2])
+    return 'exec:%s' % name
+
+def run(cmd, dryrun=False, check=True, shell=False, capture_output=False, timeout=None, cwd=None, *args):
     assert not(dryrun and capture_output) or dryrun ^ capture_output,\
         "Only one of dryrun/capture_output should be set; fix the code"
-    logger.info("{}".format(' '.join(cmd)))
+    if cwd is None:
+        logger.info("{}".format(' '.join(cmd)))
+    else:
+        logger.info("{} (in {})".format(' '.join(cmd), cwd))
     if dryrun:
         return
     try:
-        return subprocess.run(cmd, check=check, shell=shell, timeout=timeout,
-                              capture_output=capture_output, *args)
+        with span(get_command_stage(cmd)):
+            return subprocess.run(cmd, check=check, shell=shell, timeout=timeout,
+                                  capture_output=capture_output, cwd=cwd, *args)
     except subprocess.TimeoutExpired:
         if timeout is not None:
             logger.info("\"{}\" timed out".format(' '.join(cmd)))
             pass
 
+# File operations are done in-process rather than by spawning cp/mv/echo, logged like the commands run() runs.
+# Files are replaced rather than written in place, they may be links into the --artifact_store.
+def copy_file(src, dest, dryrun=False, cwd=None):
+    src, dest = [os.path.join(cwd, f) if cwd is not None else f for f in (src, dest)]
+    logger.info('cp "%s" "%s"', src, dest)
+    if dryrun:
+        return
+    shutil.copyfile(src, '%s.tmp' % dest)
+    shutil.copymode(src, '%s.tmp' % dest)
+    os.replace('%s.tmp' % dest, dest)
+
+def move_file(src, dest, dryrun=False, cwd=None):
+    src, dest = [os.path.join(cwd, f) if cwd is not None else f for f in (src, dest)]
+    logger.info('mv "%s" "%s"', src, dest)
+    if dryrun:
+        return
+    os.replace(src, dest)
+
+def append_line(filename, line, dryrun=False):
+    logger.info('echo "%s" >> "%s"', line, filename)
+    if dryrun:
+        return
+    with open(filename, 'a') as f:
+        f.write('%s\n' % line)
+
+class EndpointLimiter:
+    '''
+    Bounds the number of concurrent calls to an endpoint (the artifact api, github, the git remote).
+    When the endpoint pushes back, calls pause for its retry delay and the limit halves; it grows back
+    by one after each limit's worth of successful calls, up to max_limit.
+    '''
+    def __init__(self, name, max_limit):
+        self.name = name
+        self.max_limit = max(1, max_limit)
+        self.limit = self.max_limit
+        self.in_use = 0
+        self.successes = 0
+        self.paused_until = 0
+        self.cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self):
+        with self.cond:
+            while True:
+                pause = self.paused_until - time.time()
+                if pause <= 0 and self.in_use < self.limit:
+                    break
+                self.cond.wait(timeout=pause if pause > 0 else None)
+            self.in_use += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.in_use -= 1
+                self.cond.notify_all()
+
+    def throttled(self, delay):
+        with self.cond:
+            self.limit = max(1, self.limit // 2)
+            self.successes = 0
+            self.paused_until = max(self.paused_until, time.time() + delay)
+            logger.info("%s is throttling, pausing calls for %.1fs, concurrency limit now %d", self.name, delay, self.limit)
+
+    def succeeded(self):
+        with self.cond:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self.successes = 0
+                self.cond.notify_all()
+
+# Endpoint name -> EndpointLimiter, set up in main.
+endpoint_limiters = {}
+
+def endpoint_slot(name):
+    limiter = endpoint_limiters.get(name)
+    return limiter.slot() if limiter is not None else contextlib.nullcontext()
+
+def endpoint_throttled(name, delay):
+    limiter = endpoint_limiters.get(name)
+    if limiter is not None:
+        limiter.throttled(delay)
+
+def endpoint_succeeded(name):
+    limiter = endpoint_limiters.get(name)
+    if limiter is not None:
+        limiter.succeeded()
+
+# gh's errors when github's primary or secondary rate limits kick in.
+github_rate_limit_messages = ('secondary rate limit', 'API rate limit exceeded', 'abuse detection', 'HTTP 429')
+
+def run_gh(cmd, retries=5, **kwargs):
+    '''
+    Runs a gh command within github's concurrency limit. Rate limited calls, with check set or not, pause all
+    gh calls for --github_retry_delay (doubling on every retry) and are retried. Other failures raise as with run().
+    '''
+    for attempt in range(retries + 1):
+        with endpoint_slot('github'):
+            try:
+                out = run(cmd, **kwargs)
+                error = None
+            except subprocess.CalledProcessError as cpe:
+                out = error = cpe
+            # With check=False a failing call returns instead of raising, its output is checked all the same.
+            if out is not None and out.returncode != 0:
+                output = b''.join(o for o in (out.stderr, out.stdout) if isinstance(o, bytes)).decode('utf-8', 'replace')
+                if attempt < retries and any(m in output for m in github_rate_limit_messages):
+                    logger.info("rate limited by github (attempt %d/%d): %s", attempt + 1, retries + 1, output.strip())
+                    endpoint_throttled('github', _get_retry_delay(attempt, g_args.github_retry_delay))
+                    continue
+            if error is not None:
+                raise error
+        endpoint_succeeded('github')
+        return out
+
+def setup_endpoint_limiters(args):
+    endpoint_limiters.update({
+        'artifact_api': EndpointLimiter('artifact api', args.artifact_api_concurrency or args.download_concurrency),
+        'github': EndpointLimiter('github', args.github_concurrency),
+        'git_remote': EndpointLimiter('git remote', args.git_remote_concurrency),
+    })
+
+# Keep-alive connections, one set per worker thread, so each download worker
+# reuses its TLS session instead of reconnecting for every artifact.
+_http_local = threading.local()
+
+def _get_http_connection(url_parts, timeout=None):
+    conns = getattr(_http_local, 'conns', None)
+    if conns is None:
+        conns = _http_local.conns = {}
+    key = (url_parts.scheme, url_parts.netloc)
+    conn = conns.get(key)
+    if conn is None:
+        if url_parts.scheme == 'https':
+            conn = http.client.HTTPSConnection(url_parts.netloc, timeout=timeout)
+        else:
+            assert url_parts.scheme == 'http', "unsupported url scheme %s" % url_parts.scheme
+            conn = http.client.HTTPConnection(url_parts.netloc, timeout=timeout)
+        conns[key] = conn
+    return conn
+
+def _drop_http_connection(url_parts):
+    conns = getattr(_http_local, 'conns', {})
+    conn = conns.pop((url_parts.scheme, url_parts.netloc), None)
+    if conn is not None:
+        conn.close()
+
+def _get_retry_delay(attempt, backoff, retry_after=None):
+    if retry_after is not None:
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            pass
+    return backoff * (2 ** attempt)
+
+def get_download_validators():
+    global _download_validators
+    if _download_validators is None:
+        validators_file = os.path.join(toplevel_dir, download_validators_filename)
+        _download_validators = {}
+        if os.path.exists(validators_file):
+            with open(validators_file) as f:
+                _download_validators = json.load(f)
+    return _download_validators
+
+def save_download_validators():
+    with _download_validators_lock:
+        if _download_validators is None:
+            return
+        validators_file = os.path.join(toplevel_dir, download_validators_filename)
+        with open('%s.tmp' % validators_file, 'w') as f:
+            json.dump(_download_validators, f, indent=1, sort_keys=True)
+        os.replace('%s.tmp' % validators_file, validators_file)
+
+def get_download_validator(url, dest):
+    '''
+    Returns what was recorded when url was last downloaded to dest, None if dest changed since.
+    '''
+    with _download_validators_lock:
+        entry = get_download_validators().get(url)
+    if entry is None or entry['dest'] != os.path.abspath(dest):
+        return None
+    try:
+        st = os.stat(dest)
+    except FileNotFoundError:
+        return None
+    if [st.st_size, st.st_mtime_ns] != entry['stat']:
+        return None
+    return entry
+
+def record_download_validator(url, dest, etag, last_modified, sha256):
+    st = os.stat(dest)
+    with _download_validators_lock:
+        get_download_validators()[url] = {'dest': os.path.abspath(dest), 'stat': [st.st_size, st.st_mtime_ns],
+                                          'etag': etag, 'last_modified': last_modified, 'sha256': sha256}
+
+def indent_downloaded_json(filename):
+    '''
+    Rewrites the downloaded filename indented the way 'jq .' did when downloads were piped through it, so that
+    the committed '<dbname>_orig.json' files don't change formatting. Bodies that aren't JSON are left as is.
+    '''
+    try:
+        with open(filename, encoding='utf-8') as f:
+            contents = json.load(f)
+    except ValueError:
+        return
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(contents, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+
+@timed('download', tags=lambda url, dest, *args, **kwargs: path_tags(dest))
+def download_artifact(url, dest, bearer=None, retries=3, backoff=1.0, timeout=60, conditional=True):
+    '''
+    Downloads url to dest over a pooled keep-alive connection. 429/5xx responses and connection
+    errors are retried with exponential backoff (honoring Retry-After). The body is streamed to a
+    temporary file which replaces dest, indented (see indent_downloaded_json), only once it is complete.
+    With conditional set and dest unchanged since it was last downloaded, the request carries the
+    recorded ETag/Last-Modified and a 304, or a body identical to dest, leaves dest (and its mtime) alone.
+    Returns download_written, download_unchanged or False if the download failed.
+    '''
+    url_parts = urllib.parse.urlsplit(url)
+    path = url_parts.path or '/'
+    if url_parts.query:
+        path = '%s?%s' % (path, url_parts.query)
+    headers = {'Accept': 'application/json'}
+    if bearer is not None:
+        headers['Authorization'] = 'Bearer %s' % bearer
+    validator = get_download_validator(url, dest) if conditional else None
+    if validator is not None:
+        if validator['etag'] is not None:
+            headers['If-None-Match'] = validator['etag']
+        if validator['last_modified'] is not None:
+            headers['If-Modified-Since'] = validator['last_modified']
+    tmp_dest = '%s.part' % dest
+    for attempt in range(retries + 1):
+        try:
+            with endpoint_slot('artifact_api'):
+                conn = _get_http_connection(url_parts, timeout=timeout)
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+                if resp.status in artifact_download_retry_statuses:
+                    retry_after = resp.getheader('Retry-After')
+                    resp.read()
+                    logger.info("got %d for %s (attempt %d/%d)", resp.status, url, attempt + 1, retries + 1)
+                    endpoint_throttled('artifact_api', _get_retry_delay(attempt, backoff, retry_after))
+                elif resp.status == 304 and validator is not None:
+                    resp.read()
+                    logger.debug("%s not modified", url)
+                    endpoint_succeeded('artifact_api')
+                    return download_unchanged
+                elif resp.status != 200:
+                    resp.read()
+                    logger.error("failed to download %s: got %d %s", url, resp.status, resp.reason)
+                    return False
+                else:
+                    digest = hashlib.sha256()
+                    with open(tmp_dest, 'wb') as out:
+                        while True:
+                            chunk = resp.read(artifact_download_chunk_size)
+                            if not chunk:
+                                break
+                            digest.update(chunk)
+                            out.write(chunk)
+                    result = download_written
+                    if validator is not None and validator['sha256'] == digest.hexdigest():
+                        logger.debug("%s did not change", url)
+                        os.remove(tmp_dest)
+                        result = download_unchanged
+                    else:
+                        indent_downloaded_json(tmp_dest)
+                        os.replace(tmp_dest, dest)
+                    record_download_validator(url, dest, resp.getheader('ETag'), resp.getheader('Last-Modified'), digest.hexdigest())
+                    endpoint_succeeded('artifact_api')
+                    return result
+        except (http.client.HTTPException, OSError) as e:
+            _drop_http_connection(url_parts)
+            if os.path.exists(tmp_dest):
+                os.remove(tmp_dest)
+            logger.info("error downloading %s (attempt %d/%d): %s", url, attempt + 1, retries + 1, e)
+            # Throttled responses wait out the artifact api limiter's pause instead.
+            if attempt < retries:
+                time.sleep(_get_retry_delay(attempt, backoff))
+    logger.error("giving up downloading %s after %d attempts", url, retries + 1)
+    return False
+
+def download_many(downloads, bearer=None, concurrency=8, retries=3):
+    '''
+    Downloads (url, dest) pairs with at most concurrency requests in flight.
+    Returns a dict of dest -> whether the download succeeded.
+    '''
+    results = {}
+    if len(downloads) == 0:
+        return results
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {executor.submit(download_artifact, url, dest, bearer=bearer, retries=retries): dest
+                   for url, dest in downloads}
+        for future, dest in futures.items():
+            results[dest] = future.result()
+    return results
+
+@timed('parse')
 def process_input_names():
     '''
     Processes list of artifact ids and extracts db_links, db_names, namspaces and reviewers for each of db link.
@@ -112,6 +674,7 @@ def process_input_names():
         service_teams.append('%s-service-team-name' % namespace)
     return dblinks, dbnames, namespaces, reviewers, service_teams
 
+@timed('parse')
 def process_csv(filename=None):
     '''
     Processes a given csv and extracts db_links, db_names, namspaces and reviewers for each of db link.
@@ -119,12 +682,38 @@ def process_csv(filename=None):
     - ignores if reviewer is empty
     - ignores if dashboard isn't marked critical.
     '''
-    assert filename is not None
     dblinks = []
     dbnames = []
     namespaces = []
     reviewers = []
     service_teams = []
+    for dblink, dbname, namespace, reviewer, service_team in iter_csv(filename=filename):
+        dblinks.append(dblink)
+        dbnames.append(dbname)
+        namespaces.append(namespace)
+        service_teams.append(service_team)
+        reviewers.append(reviewer)
+    assert len(dblinks) == len(dbnames)
+    assert len(dblinks) == len(namespaces)
+    assert len(dblinks) == len(reviewers)
+    assert len(dblinks) == len(service_teams)
+    return dblinks, dbnames, namespaces, reviewers, service_teams
+
+def get_shard(key, shard_count):
+    '''
+    The shard key belongs to, the same on every host (unlike hash(), which is salted per process).
+    '''
+    return int.from_bytes(hashlib.sha1(key.encode('utf-8')).digest()[:8], 'big') % shard_count
+
+def iter_csv(filename=None):
+    '''
+    Generator behind process_csv: yields (db_link, db_name, namespace, reviewer, service_team) for each
+    csv row to be processed, as the csv is read.
+    '''
+    assert filename is not None
+    num_artifacts = 0
+    # Only needed to report the regenerate list entries that weren't found.
+    dbnames = set()
     regenerate_list = []
     regenerate = False
     skip_checks = g_args.skip_checks
@@ -160,16 +749,19 @@ def process_csv(filename=None):
     num_rows_skipped_as_marked = 0
     num_rows_skipped_regenerate = 0
     num_rows_skipped_not_new = 0
+    num_rows_other_shards = 0
+    # Artifact name -> namespace of its first row, for --shard_by namespace.
+    first_namespaces = {}
     with open(filename, newline='') as csvfile:
         csvreader = csv.reader(csvfile)
         i = -1
         num_not_created = 0
         for row in csvreader:
             i += 1
-            logger.debug("checking line: %d: %s", i, row)
+            csv_logger.debug("checking line: %d: %s", i, row)
             dblink = row[dblink_idx].strip()
             if not dblink.startswith('https'):
-                logger.info('ignoring %s', row)
+                csv_logger.info('ignoring %s', row)
                 num_rows_invalid += 1
                 continue
             only_convert_new = False
@@ -184,49 +776,51 @@ def process_csv(filename=None):
             #     continue
             to_be_converted = row[to_be_converted_idx]
             if not skip_checks and to_be_converted != 'TRUE':
-                logger.info('skipping db %s at line %d as it is not to be converted, row: %s (not-converted: %s)', dblink, i, row, only_convert_new)
+                csv_logger.info('skipping db %s at line %d as it is not to be converted, row: %s (not-converted: %s)', dblink, i, row, only_convert_new)
                 continue
             namespace = row[namespace_idx].strip()
             service_team = row[service_team_idx].strip()
             if namespace == "" or (g_args.artifact_type == "alert" and service_team == ""):
-                logger.info('skipping db  %s at line %d because namespace/service team is not listed, row: %s (not-converted: %s)', dblink, i, row, only_convert_new)
+                csv_logger.info('skipping db  %s at line %d because namespace/service team is not listed, row: %s (not-converted: %s)', dblink, i, row, only_convert_new)
                 num_rows_namespace_service_empty += 1
                 continue
             skip_generation = row[skip_generation_idx]
             dbname = dblink.split('/')[-1].strip()
             if regenerate and dbname not in regenerate_list:
-                logger.info('skipping db %s at line %d because it is not in regenerate list, row: %s (not-converted: %s)', dblink, i, row, only_convert_new)
+                csv_logger.info('skipping db %s at line %d because it is not in regenerate list, row: %s (not-converted: %s)', dblink, i, row, only_convert_new)
                 num_rows_skipped_regenerate += 1
                 continue
             elif not regenerate and (not skip_checks and skip_generation == 'TRUE'):
-                logger.info('skipping db %s at line %d because skip generation is true, row: %s (not-converted: %s)', dblink, i, row, only_convert_new)
+                csv_logger.info('skipping db %s at line %d because skip generation is true, row: %s (not-converted: %s)', dblink, i, row, only_convert_new)
                 num_rows_skipped_as_marked += 1
                 continue
             if g_args.only_convert_new and only_convert_new != "not created":
-                logger.info('skipping db %s at line %d because it is already created earlier, row: %s (not-converted: %s)', dblink, i, row, only_convert_new)
+                csv_logger.info('skipping db %s at line %d because it is already created earlier, row: %s (not-converted: %s)', dblink, i, row, only_convert_new)
                 num_rows_skipped_not_new += 1
                 continue
-            logger.info("will convert %s, %s, %s, %s, %s, %s", dblink, to_be_converted, namespace, service_team, dbname, reviewer)
-            dblinks.append(dblink)
-            dbnames.append(dbname)
-            namespaces.append(namespace)
-            service_teams.append(service_team)
-            reviewers.append(reviewer)
-    logger.info("got %d artifacts to process out of %d processed lines (num_not_created: %d)", len(dbnames), i, num_not_created)
+            if g_args.shard_count > 1:
+                # All rows of an artifact go to the shard of its first row, so only one shard ever pushes its branch.
+                shard_key = first_namespaces.setdefault(dbname, namespace) if g_args.shard_by == 'namespace' else dbname
+                if get_shard(shard_key, g_args.shard_count) != g_args.shard_index:
+                    num_rows_other_shards += 1
+                    continue
+            csv_logger.info("will convert %s, %s, %s, %s, %s, %s", dblink, to_be_converted, namespace, service_team, dbname, reviewer)
+            num_artifacts += 1
+            if regenerate:
+                dbnames.add(dbname)
+            yield dblink, dbname, namespace, reviewer, service_team
+    logger.info("got %d artifacts to process out of %d processed lines (num_not_created: %d)", num_artifacts, i, num_not_created)
     logger.info("num_rows_invalid: %d", num_rows_invalid)
     logger.info("num_rows_reviewer_empty: %d", num_rows_reviewer_empty)
     logger.info("num_rows_namespace_service_empty: %d", num_rows_namespace_service_empty)
     logger.info("num_rows_skipped_as_marked: %d", num_rows_skipped_as_marked)
     logger.info("num_rows_skipped_regenerate: %d", num_rows_skipped_regenerate)
     logger.info("num_rows_skipped_not_new: %d", num_rows_skipped_not_new)
+    if g_args.shard_count > 1:
+        logger.info("num_rows_other_shards: %d (this is shard %d of %d)", num_rows_other_shards, g_args.shard_index, g_args.shard_count)
     if regenerate and len(regenerate_list) != len(dbnames):
-        will_not_process = set(regenerate_list) - set(dbnames)
+        will_not_process = set(regenerate_list) - dbnames
         logger.info("following (%d) artifacts will not be processed: %s", len(will_not_process), will_not_process)
-    assert len(dblinks) == len(dbnames)
-    assert len(dblinks) == len(namespaces)
-    assert len(dblinks) == len(reviewers)
-    assert len(dblinks) == len(service_teams)
-    return dblinks, dbnames, namespaces, reviewers, service_teams
 
 def get_artifact_folder(folder_prefix='wf-'):
     return '%s%ss' % (folder_prefix, g_args.artifact_type)
@@ -242,6 +836,7 @@ def get_dirname(namespace, service_team, folder_prefix='wf-'):
     else:
         assert False
 
+@timed('mkdirs')
 def mkdirs(namespaces, service_teams):
     '''
     Creates the directories based on namespaces. A directory is created for each namespace and 'wf-dashboards'
@@ -258,25 +853,160 @@ def mkdirs(namespaces, service_teams):
     assert len(dirnames) == len(namespaces)
     return dirnames
 
+journal_stages = ['downloaded', 'validated', 'converted', 'committed', 'pushed', 'pr_created', 'pr_edited', 'pr_closed']
+
+def open_journal(filename):
+    '''
+    Opens (creating if needed) the journal with one row per (artifact, stage) that has completed.
+    Artifacts are keyed by their branch name, which is unique per artifact.
+    '''
+    global journal
+    journal = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+    journal.execute('PRAGMA journal_mode=WAL')
+    journal.execute('PRAGMA synchronous=NORMAL')
+    journal.execute('''CREATE TABLE IF NOT EXISTS stages (
+                           artifact_type TEXT NOT NULL,
+                           artifact TEXT NOT NULL,
+                           stage TEXT NOT NULL,
+                           completed_at REAL NOT NULL,
+                           output_hash TEXT,
+                           detail TEXT,
+                           PRIMARY KEY (artifact_type, artifact, stage))''')
+    logger.info("using journal %s", filename)
+
+def journal_record(artifact, stage, output_hash=None, detail=None, output_file=None):
+    if journal is None:
+        return
+    assert stage in journal_stages, stage
+    if output_file is not None:
+        output_hash = hash_file(output_file)
+    with journal_lock:
+        journal.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?)',
+                        (g_args.artifact_type, artifact, stage, time.time(), output_hash, detail))
+
+def journal_get(artifact):
+    '''
+    Returns stage -> {'completed_at', 'output_hash', 'detail'} for the stages artifact has completed.
+    '''
+    if journal is None:
+        return {}
+    with journal_lock:
+        rows = journal.execute('SELECT stage, completed_at, output_hash, detail FROM stages WHERE artifact_type = ? AND artifact = ?',
+                               (g_args.artifact_type, artifact)).fetchall()
+    return {stage: {'completed_at': completed_at, 'output_hash': output_hash, 'detail': detail}
+            for stage, completed_at, output_hash, detail in rows}
+
+def journal_is_done(artifact, stage, output_hash):
+    entry = journal_get(artifact).get(stage)
+    return entry is not None and output_hash is not None and entry['output_hash'] == output_hash
+
+def report_journal():
+    rows = journal.execute('SELECT stage, COUNT(*), MIN(completed_at), MAX(completed_at) FROM stages WHERE artifact_type = ? GROUP BY stage',
+                           (g_args.artifact_type,)).fetchall()
+    counts = {stage: (count, first, last) for stage, count, first, last in rows}
+    logger.info("journal progress for %ss:", g_args.artifact_type)
+    for stage in journal_stages:
+        count, first, last = counts.get(stage, (0, None, None))
+        logger.info("  %-10s %6d %s", stage, count,
+                    '' if count == 0 else '(%s - %s)' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(first)), time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last))))
+    return counts
+
+def get_conversion_key(dirname, dbname):
+    return hashlib.sha256(json.dumps(get_conversion_inputs(dirname, dbname), sort_keys=True).encode('utf-8')).hexdigest()
+
+def get_journal_progress(artifact, conversion_key):
+    '''
+    Works out from the journal how far artifact got with conversion_key as input: None, 'committed', 'pushed'
+    or the last PR stage ('pr_created' or 'pr_closed') along with its PR link.
+    '''
+    entries = journal_get(artifact)
+    committed = entries.get('committed')
+    if committed is None or committed['detail'] != conversion_key:
+        return None, None
+    pushed = entries.get('pushed')
+    if pushed is None or pushed['detail'] != conversion_key or pushed['completed_at'] < committed['completed_at']:
+        return 'committed', None
+    for pr_stage in ['pr_created', 'pr_closed']:
+        pr = entries.get(pr_stage)
+        if pr is not None and pr['completed_at'] >= pushed['completed_at']:
+            return pr_stage, pr['detail']
+    return 'pushed', None
+
+validation_cache_filename = '.kf_validation_cache.json'
+# Stored with each validation result, results of an older validation are not reused.
+validation_version = 3
+_validation_cache = None
+_validation_cache_lock = threading.Lock()
+_validation_cache_dirty = False
+
+def get_validation_cache():
+    global _validation_cache
+    if _validation_cache is None:
+        cache_file = os.path.join(toplevel_dir, validation_cache_filename)
+        _validation_cache = {}
+        if os.path.exists(cache_file):
+            with open(cache_file) as f:
+                _validation_cache = json.load(f)
+    return _validation_cache
+
+def save_validation_cache():
+    global _validation_cache_dirty
+    with _validation_cache_lock:
+        if not _validation_cache_dirty:
+            return
+        cache_file = os.path.join(toplevel_dir, validation_cache_filename)
+        with open('%s.tmp' % cache_file, 'w') as f:
+            json.dump(_validation_cache, f)
+        os.replace('%s.tmp' % cache_file, cache_file)
+        _validation_cache_dirty = False
+
+@timed('validate', tags=path_tags)
+def is_valid_artifact(db_filename, artifact_type):
+    '''
+    Results are cached by (path, size, mtime), files that did not change since they were validated are not read again.
+    '''
+    global _validation_cache_dirty
+    try:
+        st = os.stat(db_filename)
+    except FileNotFoundError:
+        return False
+    if st.st_size == 0:
+        return False
+    cache_key = '%s:%s' % (artifact_type, os.path.abspath(db_filename))
+    with _validation_cache_lock:
+        cached = get_validation_cache().get(cache_key)
+    if cached is not None and cached[:2] == [st.st_size, st.st_mtime_ns] and cached[3:] == [validation_version]:
+        logger.debug("validated before (file: %s, size: %s, valid: %s)", db_filename, st.st_size, cached[2])
+        return cached[2]
+    try:
+        with open(db_filename, 'rb') as dbf:
+            contents = json.loads(dbf.read())
+        well_formed = True
+    except ValueError:
+        contents = None
+        well_formed = False
+    invalid = not well_formed
+    # alerts are only invalid if the download returned a non 200 status, which is all that is looked at.
+    if artifact_type == "alert" and isinstance(contents, dict) and isinstance(contents.get("status"), dict):
+        invalid = contents["status"].get("code") != 200
+    with _validation_cache_lock:
+        get_validation_cache()[cache_key] = [st.st_size, st.st_mtime_ns, not invalid, validation_version]
+        _validation_cache_dirty = True
+    if invalid:
+        logger.debug("exist but invalid (file: %s, well formed: %s, size: %s)", db_filename, well_formed, st.st_size)
+        return False
+    logger.debug("exist and valid (file: %s, size: %s)", db_filename, st.st_size)
+    return True
+
+@timed('download_all')
 def download_artifacts(artifact_type, dbnames, dirnames, namespaces, service_teams, force=False, dryrun=False):
     '''
     download the db in the link and store that in it's corresponding namespace directory.
     '''
-    def _check_exists_and_valid(dbname):
-        dbfilenames = ['%s.json' % dbname, '%s_orig.json' % dbname]
+    def _check_exists_and_valid(dbname, dirname=''):
+        dbfilenames = [os.path.join(dirname, '%s.json' % dbname), os.path.join(dirname, '%s_orig.json' % dbname)]
         for db_filename in dbfilenames:
-            if os.path.exists(db_filename) and os.path.getsize(db_filename) != 0:
-                import json
-                invalid = False
-                with open(db_filename) as dbf:
-                    contents = json.loads(dbf.read())
-                    if artifact_type == "alert":
-                        if "status" in contents and contents["status"]["code"] != 200:
-                            invalid = True
-                if invalid:
-                    logger.debug("exist but invalid (file: %s, exists: %s, size: %s)", db_filename, os.path.exists(db_filename), os.path.getsize(db_filename))
-                    continue
-                logger.debug("exist and valid (file: %s, exists: %s, size: %s)", db_filename, os.path.exists(db_filename), os.path.getsize(db_filename))
+            if is_valid_artifact(db_filename, artifact_type):
                 return True
         logger.debug("does not exist or invalid (file: %s)", dbfilenames)
         return False
@@ -285,11 +1015,17 @@ def download_artifacts(artifact_type, dbnames, dirnames, namespaces, service_tea
         base_file = '%s.json' % dbname
         logger.info("will copy as needed, working_dir: %s, orig_file: %s (exist: %s), base_file: %s (exist: %s)", os.getcwd(), orig_file, os.path.exists(orig_file), base_file, os.path.exists(base_file))
         if os.path.exists(orig_file) and not os.path.exists(base_file):
-            run(['cp %s %s' % (orig_file, base_file)])
+            copy_file(orig_file, base_file)
         assert os.path.exists(base_file)
     num_downloaded = 0
+    num_unchanged = 0
     start_from = g_args.start_from
     end_at = g_args.end_at
+    # Downloads are only queued while walking the branches and fetched together afterwards.
+    # The downloaded '<dbname>.json' is untracked, so it stays in place when other branches are checked out.
+    pending_downloads = []
+    # Whatever is checked out when starting, main is checked out explicitly the first time it's needed.
+    checked_out = None
     for i in range(len(dbnames)):
         logger.info("downloading artifact: dirname: %s, namespace: %s, service_team: %s, dbname: %s", dirnames[i], namespaces[i], service_teams[i], dbnames[i])
         if start_from is not None:
@@ -308,44 +1044,510 @@ def download_artifacts(artifact_type, dbnames, dirnames, namespaces, service_tea
             logger.info('creating dir %s', dirname)
             os.makedirs(dirnames[i], exist_ok=True)
         branchname = get_branchname(namespaces[i], service_teams[i], dbnames[i])
-        failed = checkout_branch(branchname, dryrun=dryrun)
-        if failed:
-            logger.debug("failed to check out branch: %s", branchname)
-            checkout_branch("main", existing=True)
+        if not force and journal is not None and journal_is_done(branchname, 'validated', hash_file(os.path.join(dirnames[i], '%s.json' % dbnames[i]))):
+            logger.info("not downloading %s, the journal has it downloaded and validated", dbnames[i])
+            if end_at is not None and dbnames[i] == end_at:
+                break
             continue
+        # A branch that doesn't exist yet has nothing of the artifact, the branch is only created when committing.
+        publish_branchname = get_publish_branchname(namespaces[i], service_teams[i], dbnames[i])
+        if checkout_branch(publish_branchname, existing=True, dryrun=dryrun):
+            logger.debug("no branch %s (yet)", branchname)
+            # The artifact is looked for as on main, not on the branch of the previous artifact.
+            if checked_out != 'main':
+                checkout_branch("main", existing=True, dryrun=dryrun)
+                checked_out = 'main'
+                # Checking out main may have removed the directory, if only the previous branch had files in it.
+                os.makedirs(dirnames[i], exist_ok=True)
+                os.chdir(dirnames[i])
+        else:
+            checked_out = publish_branchname
         logger.info("current working dir: %s (dirname: %s)", os.getcwd(), dirnames[i])
         assert os.getcwd() == dirnames[i]
         db_filename = '%s.json' % dbnames[i]
         logger.info("checking if %s already exists: %s (force:%s)", db_filename, os.path.exists(db_filename), force)
         if force or not _check_exists_and_valid(dbnames[i]):
-            logger.info('downloading %s to %s (force: %s, exists: %s, size: %s',
+            logger.info('queueing download of %s to %s (force: %s, exists: %s, size: %s',
                         dbnames[i], db_filename, force, os.path.exists(db_filename), os.path.getsize(db_filename) if os.path.exists(db_filename) else 'NA')
-            download_cmd = artifact_download_cmd_str % (g_args.artifact_download_url %(artifact_type, dbnames[i]), g_args.bearer, db_filename)
-            r = run([download_cmd], dryrun=dryrun)
-            if r.returncode != 0:
-                logger.error("failed to download (cmd: %s)", download_cmd)
-            num_downloaded += 1
+            pending_downloads.append(i)
         else:
             logger.info('not downloading %s', db_filename)
             _copy_if_needed(dbnames[i])
-        if not _check_exists_and_valid(dbnames[i]):
-            logger.error("found zero size or invalid artifact file: %s", os.path.join(dirnames[i], db_filename))
-            global invalidArtifactFiles
-            invalidArtifactFiles.update({dbnames[i]:os.path.join(dirnames[i], db_filename)})
-        checkout_branch("main", existing=True)
+            if not _check_exists_and_valid(dbnames[i]):
+                logger.error("found zero size or invalid artifact file: %s", os.path.join(dirnames[i], db_filename))
+                invalidArtifactFiles.update({dbnames[i]:os.path.join(dirnames[i], db_filename)})
+            else:
+                journal_record(branchname, 'validated', output_file=os.path.join(dirnames[i], db_filename))
         if end_at is not None and dbnames[i] == end_at:
             break
+    # Branches are checked out one after the other (new ones start from main), main only once all are looked at.
+    checkout_branch("main", existing=True)
     os.chdir(toplevel_dir)
-    logger.debug("downloaded %d dashboards", num_downloaded)
+    # An artifact listed for several namespaces is downloaded once and linked into the other namespaces.
+    dests = {}
+    for i in pending_downloads:
+        dests.setdefault(g_args.artifact_download_url % (artifact_type, dbnames[i]), []).append(os.path.join(dirnames[i], '%s.json' % dbnames[i]))
+    downloads = [(url, url_dests[0]) for url, url_dests in dests.items()]
+    logger.info("downloading %d artifacts for %d files (concurrency: %d)", len(downloads), len(pending_downloads), g_args.download_concurrency)
+    if dryrun:
+        for url, dest in downloads:
+            logger.info("would download %s to %s", url, dest)
+        return
+    results = download_many(downloads, bearer=g_args.bearer, concurrency=g_args.download_concurrency, retries=g_args.download_retries)
+    for url, url_dests in dests.items():
+        if not results[url_dests[0]]:
+            results.update({dest: False for dest in url_dests[1:]})
+            continue
+        source = url_dests[0]
+        if g_args.artifact_store is not None:
+            digest = store_artifact(source)
+            source = os.path.join(g_args.artifact_store, 'objects', digest[:2], digest)
+        for dest in url_dests[1:]:
+            logger.debug("linking %s to %s", dest, source)
+            link_or_copy(source, dest)
+            results[dest] = download_written
+    for i in pending_downloads:
+        db_filename = os.path.join(dirnames[i], '%s.json' % dbnames[i])
+        branchname = get_branchname(namespaces[i], service_teams[i], dbnames[i])
+        if results[db_filename] == download_unchanged:
+            num_unchanged += 1
+        if results[db_filename]:
+            num_downloaded += 1
+            journal_record(branchname, 'downloaded', output_file=db_filename)
+        if not _check_exists_and_valid(dbnames[i], dirname=dirnames[i]):
+            logger.error("found zero size or invalid artifact file: %s", db_filename)
+            invalidArtifactFiles.update({dbnames[i]:db_filename})
+        else:
+            journal_record(branchname, 'validated', output_file=db_filename)
+    save_validation_cache()
+    save_download_validators()
+    logger.debug("downloaded %d dashboards (%d unchanged)", num_downloaded, num_unchanged)
+
+def get_branch_files(branchname, dirname):
+    '''
+    Returns the names of the files committed in dirname on branchname, without checking the branch out.
+    Empty if the branch doesn't exist (yet).
+    '''
+    reldir = os.path.relpath(dirname, toplevel_dir)
+    out = run(['git', 'ls-tree', '--name-only', branchname, '--', '%s/' % reldir], shell=False, check=False, capture_output=True)
+    if out is None or out.returncode != 0:
+        return set()
+    return set(os.path.basename(f) for f in out.stdout.decode('utf-8').splitlines())
+
+def hash_file(filename):
+    if filename is None or not os.path.exists(filename):
+        return None
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+_converter_fingerprint = None
+# Query translation config of kfuse_parser's wavefront, datadog and signalfx parsers, when kept next to the converter.
+parser_conf_filenames = ['wql_parser_conf.yaml', 'ddql_parser_conf.yaml', 'sfxql_parser_conf.yaml']
+
+def get_converter_fingerprint():
+    '''
+    Hashes of everything besides the artifact itself that determines the converter's output:
+    the settings, the notificants (alerts only), the converter binary with its kfuse_parser eggs
+    and the query parser confs.
+    '''
+    global _converter_fingerprint
+    if _converter_fingerprint is None:
+        version = hashlib.sha256()
+        for filename in [os.path.join(converter_abs_dir, '%s_converter' % g_args.artifact_type)] + sorted(glob.glob(os.path.join(converter_abs_dir, 'kfuse_parser-*.egg'))):
+            version.update(('%s:%s;' % (os.path.basename(filename), hash_file(filename))).encode('utf-8'))
+        _converter_fingerprint = {
+            'settings': hash_file(get_converter_settings_file()),
+            'notificants': hash_file(os.path.join(converter_abs_dir, 'notificants.json')) if g_args.artifact_type == 'alert' else None,
+            'converter': version.hexdigest(),
+        }
+        parser_confs = hashlib.sha256()
+        found = False
+        for filename in parser_conf_filenames:
+            if os.path.exists(os.path.join(converter_abs_dir, filename)):
+                parser_confs.update(('%s:%s;' % (filename, hash_file(os.path.join(converter_abs_dir, filename)))).encode('utf-8'))
+                found = True
+        # Only present when there are confs, so the conversions recorded before they were hashed stay valid.
+        if found:
+            _converter_fingerprint['parser_conf'] = parser_confs.hexdigest()
+    return _converter_fingerprint
+
+# The converter settings and parser confs as validated by compile_converter_config, stamped with the hashes of the files.
+converter_config_snapshot_filename = '.kf_converter_config.json'
+converter_config_snapshot_version = 2
+custom_tag_policies = ['split', 'drop', 'replace_with_default']
+parser_conf_mappings = ['SpaceAggrVars', 'TimeAggrVars', 'FunctionVars', 'Sanitize', 'Operators', 'RangeTranslations',
+                        'UnitTranslations', 'MetricNameTranslations', 'VarsMapping']
+parser_conf_lists = ['NoopFuncs', 'CustomTagRules', 'AdditionalDescriptions']
+
+def get_converter_settings_file():
+    return os.path.join(converter_abs_dir, 'conversion_settings.yaml')
+
+def get_converter_config_files():
+    '''
+    The config files the converter reads: the settings it's given with -c (see get_converter_cmd) and the parser confs.
+    '''
+    files = [get_converter_settings_file()]
+    files += [os.path.join(converter_abs_dir, f) for f in parser_conf_filenames if os.path.exists(os.path.join(converter_abs_dir, f))]
+    return files
+
+def check_parser_conf(conf, where, errors):
+    '''
+    Checks the query parser settings in conf: a *_parser_conf.yaml or the ParserConfig of the converter settings.
+    '''
+    for key in parser_conf_mappings:
+        if conf.get(key) is not None and not isinstance(conf[key], dict):
+            errors.append('%s%s is not a mapping' % (where, key))
+    for key in parser_conf_lists:
+        if conf.get(key) is not None and not isinstance(conf[key], list):
+            errors.append('%s%s is not a list' % (where, key))
+    for i, rule in enumerate(conf.get('CustomTagRules') or []):
+        rule_where = '%sCustomTagRules[%d]' % (where, i)
+        if not isinstance(rule, dict) or 'Tagname' not in rule:
+            errors.append('%s has no Tagname' % rule_where)
+            continue
+        if 'Policy' in rule and rule['Policy'] not in custom_tag_policies:
+            errors.append('%s has policy %s, not one of %s' % (rule_where, rule['Policy'], ', '.join(custom_tag_policies)))
+        if rule.get('Policy') == 'split' and not rule.get('Splitrules'):
+            errors.append('%s has policy split but no Splitrules' % rule_where)
+        for j, split in enumerate(rule.get('Splitrules') or []):
+            missing = [key for key in ['Tagname', 'Lookup', 'Use'] if not isinstance(split, dict) or key not in split]
+            if len(missing) != 0:
+                errors.append('%s.Splitrules[%d] has no %s' % (rule_where, j, ', '.join(missing)))
+
+def check_converter_config(config, errors, regexes):
+    '''
+    Checks a parsed config file, adding what's wrong to errors and the regexes it configures to regexes.
+    '''
+    if not isinstance(config, dict):
+        errors.append('not a mapping')
+        return
+    check_parser_conf(config, '', errors)
+    if config.get('ParserConfig') is not None:
+        if isinstance(config['ParserConfig'], dict):
+            check_parser_conf(config['ParserConfig'], 'ParserConfig.', errors)
+        else:
+            errors.append('ParserConfig is not a mapping')
+    for i, notificant in enumerate(config.get('NotificantSettings') or []):
+        if not isinstance(notificant, dict) or 'name' not in notificant:
+            errors.append('NotificantSettings[%d] has no name' % i)
+    rules = config.get('AlertConversionRules') or {}
+    name_checks = rules.get('alert_name_checks') or {} if isinstance(rules, dict) else {}
+    if isinstance(name_checks, dict) and name_checks.get('regex') is not None:
+        try:
+            re.compile(name_checks['regex'])
+            regexes['AlertConversionRules.alert_name_checks.regex'] = name_checks['regex']
+        except re.error as e:
+            errors.append('AlertConversionRules.alert_name_checks.regex: %s' % e)
 
-def check_if_conversion_needed(dirname=None, dbname=None, force_convert=False, dryrun=False):
-    # converted files don't exist, so convert.
+def compile_converter_config(config_files, snapshot_file=None):
+    '''
+    Validates the converter settings and parser confs once and writes the hashes of the files, with the keys and
+    regexes (checked to compile) that were validated, to snapshot_file (if given).
+    Returns the snapshot, None if a file is invalid.
+    '''
+    if yaml is None:
+        logger.error("validating the converter config needs pyyaml")
+        return None
+    snapshot = {'version': converter_config_snapshot_version, 'sources': {}, 'keys': {}, 'regexes': {}}
+    valid = True
+    for filename in config_files:
+        filename = os.path.abspath(filename)
+        errors = []
+        regexes = {}
+        try:
+            with open(filename) as f:
+                config = yaml.safe_load(f)
+            check_converter_config(config, errors, regexes)
+        except (OSError, yaml.YAMLError) as e:
+            errors.append(str(e))
+        if len(errors) != 0:
+            logger.error("%s is not a valid converter config: %s", filename, lazy_pformat(errors))
+            valid = False
+            continue
+        snapshot['sources'][filename] = hash_file(filename)
+        snapshot['keys'][filename] = sorted(str(key) for key in config)
+        snapshot['regexes'].update({'%s:%s' % (os.path.basename(filename), key): regex for key, regex in regexes.items()})
+    if not valid:
+        return None
+    if snapshot_file is None:
+        logger.info("%d converter config files are valid", len(config_files))
+        return snapshot
+    with open('%s.tmp' % snapshot_file, 'w') as f:
+        json.dump(snapshot, f, indent=1, sort_keys=True)
+    os.replace('%s.tmp' % snapshot_file, snapshot_file)
+    logger.info("compiled %d converter config files to %s", len(config_files), snapshot_file)
+    return snapshot
+
+def get_converter_config(snapshot_file):
+    '''
+    Returns the snapshot of the config files the converter reads (see get_converter_config_files), compiling it
+    again if they are not the files in snapshot_file or any of them changed.
+    '''
+    config_files = [os.path.abspath(filename) for filename in get_converter_config_files()]
+    with open(snapshot_file) as f:
+        snapshot = json.load(f)
+    sources = snapshot.get('sources', {})
+    if snapshot.get('version') == converter_config_snapshot_version and sorted(sources) == sorted(config_files) and \
+            all(os.path.exists(filename) and hash_file(filename) == digest for filename, digest in sources.items()):
+        logger.debug("converter config snapshot %s is up to date", snapshot_file)
+        return snapshot
+    logger.info("converter config changed since %s was compiled, compiling it again", snapshot_file)
+    return compile_converter_config(config_files, snapshot_file)
+
+def get_converter_config_snapshot_file(args):
+    return args.converter_config_snapshot if args.converter_config_snapshot is not None else os.path.join(toplevel_dir, converter_config_snapshot_filename)
+
+# Per artifact directory: dbname -> hashes of the inputs its converted files were produced from.
+conversion_manifest_filename = '.kf_conversion_manifest.json'
+_conversion_manifests = {}
+_conversion_manifests_dirty = set()
+
+def get_conversion_manifest(dirname):
+    if dirname not in _conversion_manifests:
+        manifest_file = os.path.join(dirname, conversion_manifest_filename)
+        manifest = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+        _conversion_manifests[dirname] = manifest
+    return _conversion_manifests[dirname]
+
+def get_conversion_inputs(dirname, dbname):
+    inputs = {'input': hash_file(os.path.join(dirname, '%s.json' % dbname))}
+    inputs.update(get_converter_fingerprint())
+    return inputs
+
+def record_conversion(dirname, dbname, inputs):
+    '''
+    Recorded in memory, the manifests are written once at the end of the run (see save_conversion_manifests).
+    An artifact whose record is lost counts as changed and is converted again.
+    '''
+    get_conversion_manifest(dirname)[dbname] = inputs
+    _conversion_manifests_dirty.add(dirname)
+
+def save_conversion_manifests():
+    for dirname in sorted(_conversion_manifests_dirty):
+        # Checking out main removes a directory only the artifact branches had files in.
+        os.makedirs(dirname, exist_ok=True)
+        manifest_file = os.path.join(dirname, conversion_manifest_filename)
+        with open('%s.tmp' % manifest_file, 'w') as f:
+            json.dump(_conversion_manifests[dirname], f, indent=1, sort_keys=True)
+        os.replace('%s.tmp' % manifest_file, manifest_file)
+    _conversion_manifests_dirty.clear()
+
+def conversion_inputs_changed(dirname, dbname):
+    recorded = get_conversion_manifest(dirname).get(dbname)
+    current = get_conversion_inputs(dirname, dbname)
+    if recorded != current:
+        logger.info("conversion inputs of %s changed (recorded: %s, current: %s)", dbname, recorded, current)
+        return True
+    return False
+
+def link_or_copy(src, dest):
+    '''
+    Hardlinks src to dest, replacing dest. Copies when they are on different file systems.
+    Files that may be linked are only ever replaced, never written in place.
+    '''
+    tmp_dest = '%s.%d.link' % (dest, threading.get_ident())
+    try:
+        os.link(src, tmp_dest)
+    except OSError:
+        shutil.copyfile(src, tmp_dest)
+    os.replace(tmp_dest, dest)
+
+def store_artifact(filename):
+    '''
+    Adds filename to the --artifact_store as objects/<sha256> and returns the hash.
+    '''
+    digest = hash_file(filename)
+    obj = os.path.join(g_args.artifact_store, 'objects', digest[:2], digest)
+    if not os.path.exists(obj):
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        link_or_copy(filename, obj)
+    return digest
+
+def get_stored_conversion_dir(dbname, inputs):
+    '''
+    The --artifact_store keeps the converter outputs of each dbname and conversion inputs (see get_conversion_inputs).
+    '''
+    key = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(g_args.artifact_store, 'conversions', key[:2], '%s-%s' % (dbname, key))
+
+# Conversions linked from the --artifact_store (hits) and run because it had none (misses), guarded by summary_lock.
+conversion_store_stats = {'hits': 0, 'misses': 0}
+
+def count_conversion_store(hit):
+    with summary_lock:
+        conversion_store_stats['hits' if hit else 'misses'] += 1
+
+def prune_conversion_store(max_conversions, dryrun=False):
+    '''
+    Keeps the max_conversions most recently used conversions of the --artifact_store, removing the rest.
+    Reusing a conversion marks it used (see stage_conversion), so this evicts the least recently used ones.
+    '''
+    stored = []
+    for store_dir in glob.glob(os.path.join(g_args.artifact_store, 'conversions', '*', '*')):
+        if store_dir.endswith('.tmp'):
+            continue
+        try:
+            stored.append((os.stat(store_dir).st_mtime, store_dir))
+        except FileNotFoundError:
+            continue
+    if len(stored) <= max_conversions:
+        return
+    stored.sort(reverse=True)
+    logger.info("evicting %d of %d stored conversions", len(stored) - max_conversions, len(stored))
+    for _, store_dir in stored[max_conversions:]:
+        if dryrun:
+            logger.info("would evict %s", store_dir)
+            continue
+        logger.debug("evicting %s", store_dir)
+        shutil.rmtree(store_dir, ignore_errors=True)
+
+def store_conversion(converted_files, store_dir):
+    tmp_dir = '%s.%d.tmp' % (store_dir, threading.get_ident())
+    os.makedirs(tmp_dir, exist_ok=True)
+    for converted_file in converted_files:
+        link_or_copy(converted_file, os.path.join(tmp_dir, os.path.basename(converted_file)))
+    try:
+        os.rename(tmp_dir, store_dir)
+    except OSError:
+        # Stored by someone else in the meantime.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def stream_artifacts(args):
+    '''
+    Parse and mkdir stages of the streaming pipeline: yields each artifact to process (honoring
+    --start_from/--end_at) as soon as its csv row is read and its directory exists.
+    '''
+    if args.input_names is not None:
+        rows = zip(*process_input_names())
+    else:
+        rows = iter_csv(filename=args.input_file)
+    start_from = args.start_from
+    seen = set()
+    i = -1
+    for dblink, dbname, namespace, reviewer, service_team in rows:
+        i += 1
+        if start_from is not None:
+            if dbname != start_from:
+                continue
+            start_from = None
+        dirname = get_dirname(namespace, service_team)
+        os.makedirs(dirname, exist_ok=True)
+        # Artifacts flow through the later stages out of order; the first csv row of an artifact is the one used.
+        yield {'index': i, 'dbname': dbname, 'dblink': dblink, 'dirname': dirname, 'namespace': namespace,
+               'service_team': service_team, 'reviewers': reviewer, 'duplicate': dbname in seen}
+        seen.add(dbname)
+        if args.end_at is not None and dbname == args.end_at:
+            break
+
+@timed('restore', tags=lambda branchname, dirname, dbname: (dbname, path_tags(dirname)[1]))
+def restore_artifact_from_branch(branchname, dirname, dbname):
+    '''
+    Writes '<dbname>.json' from the '<dbname>_orig.json' committed on branchname, without checking the branch out.
+    '''
+    orig_file = os.path.join(os.path.relpath(dirname, toplevel_dir), '%s_orig.json' % dbname)
+    out = run(['git', 'show', '%s:./%s' % (branchname, orig_file)], shell=False, check=False, capture_output=True, cwd=toplevel_dir)
+    if out.returncode != 0:
+        return False
+    db_filename = os.path.join(dirname, '%s.json' % dbname)
+    # Replaced rather than rewritten, db_filename may be a link into the --artifact_store.
+    with open('%s.tmp' % db_filename, 'wb') as dbf:
+        dbf.write(out.stdout)
+    os.replace('%s.tmp' % db_filename, db_filename)
+    return True
+
+@timed('prepare', tags=item_tags)
+def prepare_artifact(item, force=False):
+    '''
+    Download stage of the streaming pipeline: makes sure a valid '<dbname>.json' is in the artifact's
+    directory, reusing the one there or on the artifact's branch unless force is set.
+    Invalid artifacts are recorded in invalidArtifactFiles. Returns item.
+    '''
+    dbname = item['dbname']
+    dirname = item['dirname']
+    db_filename = os.path.join(dirname, '%s.json' % dbname)
+    orig_filename = os.path.join(dirname, '%s_orig.json' % dbname)
+    if item['duplicate']:
+        return item
+    branchname = get_branchname(item['namespace'], item['service_team'], dbname)
+    if not force and journal is not None and journal_is_done(branchname, 'validated', hash_file(db_filename)):
+        logger.info("not downloading %s, the journal has it downloaded and validated", dbname)
+        return item
+    if force or not (is_valid_artifact(db_filename, g_args.artifact_type) or is_valid_artifact(orig_filename, g_args.artifact_type)):
+        restored = False
+        if not force:
+            publish_branchname = get_publish_branchname(item['namespace'], item['service_team'], dbname)
+            restored = restore_artifact_from_branch(publish_branchname, dirname, dbname) and is_valid_artifact(db_filename, g_args.artifact_type)
+        if not restored:
+            logger.info('downloading %s to %s (force: %s)', dbname, db_filename, force)
+            if download_artifact(g_args.artifact_download_url % (g_args.artifact_type, dbname), db_filename,
+                                 bearer=g_args.bearer, retries=g_args.download_retries):
+                journal_record(branchname, 'downloaded', output_file=db_filename)
+    elif not os.path.exists(db_filename):
+        shutil.copyfile(orig_filename, db_filename)
+    if not is_valid_artifact(db_filename, g_args.artifact_type):
+        logger.error("found zero size or invalid artifact file: %s", db_filename)
+        with summary_lock:
+            invalidArtifactFiles.update({dbname:db_filename})
+    else:
+        journal_record(branchname, 'validated', output_file=db_filename)
+    return item
+
+def run_stage(func, items, num_workers, queue_size, name):
+    '''
+    Runs func over items on num_workers threads and yields what it returns, in completion order.
+    items is consumed lazily and both sides are bounded queues, so a slow stage holds back the ones before it.
+    '''
+    in_queue = queue.Queue(maxsize=queue_size)
+    out_queue = queue.Queue(maxsize=queue_size)
+    def _feed():
+        try:
+            for item in items:
+                in_queue.put(item)
+        except Exception:
+            logger.error("%s stage: failed reading its input: %s", name, traceback.format_exc())
+        for _ in range(num_workers):
+            in_queue.put(None)
+    def _work():
+        while True:
+            item = in_queue.get()
+            if item is None:
+                out_queue.put(None)
+                return
+            try:
+                result = func(item)
+            except Exception:
+                logger.error("%s stage: failed on %s: %s", name, item, traceback.format_exc())
+                continue
+            if result is not None:
+                out_queue.put(result)
+    threading.Thread(target=_feed, name='%s-feed' % name, daemon=True).start()
+    for n in range(num_workers):
+        threading.Thread(target=_work, name='%s-%d' % (name, n), daemon=True).start()
+    num_done = 0
+    while num_done < num_workers:
+        result = out_queue.get()
+        if result is None:
+            num_done += 1
+            continue
+        yield result
+
+def check_if_conversion_needed(dirname=None, dbname=None, force_convert=False, dryrun=False, branch_files=()):
+    # converted files don't exist (neither in the working tree nor on the artifact's branch), so convert.
+    # With --incremental_convert, also convert if the artifact, settings or converter changed since.
     if g_args.artifact_type == "dashboard":
         outfile = os.path.join(dirname, '%s_grafana.json' % dbname)
-        exists = os.path.exists(outfile)
+        exists = os.path.exists(outfile) or os.path.basename(outfile) in branch_files
         logger.debug("checking if file %s exist: %s", outfile, exists)
         if exists:
-            if not force_convert:
+            if not force_convert and g_args.incremental_convert and conversion_inputs_changed(dirname, dbname):
+                logger.info("converted file %s exist, but its inputs changed", outfile)
+            elif not force_convert:
                 logger.info("no conversion needed for %s as converted file exist", outfile)
                 return False
             logger.info("converted files (%s) exist, but force convert is true", outfile)
@@ -355,40 +1557,44 @@ def check_if_conversion_needed(dirname=None, dbname=None, force_convert=False, d
         base_file = os.path.join(dirname, '%s.yaml' % dbname)
         orig_file = os.path.join(dirname, '%s_orig.yaml' % dbname)
         files = glob.glob(os.path.join(dirname, '%s*_pharos.yaml' % dbname))
+        files += [os.path.join(dirname, f) for f in fnmatch.filter(branch_files, '%s*_pharos.yaml' % dbname)]
         logger.debug("checking if converted files %s exist: %s, force: %s", files, len(files), force_convert)
         if len(files) > 0:
-            if not force_convert:
+            if not force_convert and g_args.incremental_convert and conversion_inputs_changed(dirname, dbname):
+                logger.info("converted files (%s) exist, but their inputs changed", files)
+            elif not force_convert:
                 logger.info("no conversion needed for %s as converted files (%s) exist", dbname, files)
                 return False
             logger.info("converted files (%s) exist, but force_convert is on", files)
         if os.path.exists(orig_file) and not os.path.exists(base_file):
             logger.debug("copying base file %s, copying from: %s", base_file, orig_file)
-            cp_cmd = 'cp %s %s' % (orig_file, base_file)
-            run([cp_cmd], dryrun=dryrun)
+            copy_file(orig_file, base_file, dryrun=dryrun)
         logger.info("conversion needed for %s (force: %s)", dbname, force_convert)
         return True
     assert False
 
-def rename_if_necesasry(dirname=None, dbname=None, dryrun=False):
+def rename_if_necesasry(dirname=None, dbname=None, dryrun=False, cwd=None, tracked=None):
+    '''
+    tracked are the names of the files committed in dirname, if known. Only those are renamed with git mv,
+    the others are renamed in-process.
+    '''
+    def _git_mv(oldfile, newfile, fallback):
+        if tracked is None or os.path.basename(oldfile) in tracked:
+            try:
+                run(['git', 'mv', oldfile, newfile], dryrun=dryrun, cwd=cwd)
+                return
+            except subprocess.CalledProcessError:
+                pass
+        fallback(oldfile, newfile, dryrun=dryrun)
     if g_args.artifact_type == 'dashboard':
         oldfile = os.path.join(dirname, '%s_prom.json' % dbname)
         if os.path.exists(oldfile):
             newfile = os.path.join(dirname, '%s_wf_prom.json' % dbname)
-            try:
-                mv_cmd = 'git mv "%s" "%s"' % (oldfile, newfile)
-                run([mv_cmd], dryrun=dryrun)
-            except:
-                cp_cmd = 'cp "%s" "%s"' % (oldfile, newfile)
-                run([cp_cmd], dryrun=dryrun)
+            _git_mv(oldfile, newfile, copy_file)
         oldfile = os.path.join(dirname, '%s.json' % dbname)
         if os.path.exists(oldfile):
             newfile = os.path.join(dirname, '%s_orig.json' % dbname)
-            try:
-                mv_cmd = 'git mv "%s" "%s"' % (oldfile, newfile)
-                run([mv_cmd], dryrun=dryrun)
-            except:
-                cp_cmd = 'cp "%s" "%s"' % (oldfile, newfile)
-                run([cp_cmd], dryrun=dryrun)
+            _git_mv(oldfile, newfile, copy_file)
     elif g_args.artifact_type == 'alert':
         oldfiles = [os.path.join(dirname, '%s.json' % dbname),
                     os.path.join(dirname, '%s_cortex.yaml' % dbname),
@@ -400,12 +1606,7 @@ def rename_if_necesasry(dirname=None, dbname=None, dryrun=False):
             oldfile = oldfiles[i]
             newfile = newfiles[i]
             if os.path.exists(oldfile):
-                try:
-                    mv_cmd = 'git mv "%s" "%s"' % (oldfile, newfile)
-                    run([mv_cmd], dryrun=dryrun)
-                except:
-                    mv_cmd = 'mv "%s" "%s"' % (oldfile, newfile)
-                    run([mv_cmd], dryrun=dryrun)
+                _git_mv(oldfile, newfile, move_file)
     else:
         assert False
 
@@ -418,8 +1619,7 @@ def create_dblink_file(dirname=None, dbname=None, dblink=None, dryrun=False):
     if os.path.exists(link_file):
         return
     logger.info("writing db link (%s) to file %s", dblink, link_file)
-    write_linkfile_cmd = 'echo "%s" >> "%s"' % (dblink, link_file)
-    run([write_linkfile_cmd], dryrun=dryrun)
+    append_line(link_file, dblink, dryrun=dryrun)
 
 def get_pr_link(pr_num):
     pr_link = 'https://ghe.megaleo.com/wavefront-migration/dashboards/pull/%s' % pr_num
@@ -427,66 +1627,489 @@ def get_pr_link(pr_num):
         pr_link = 'https://ghe.megaleo.com/wavefront-migration/alerts/pull/%s' % pr_num
     return pr_link
 
-def get_generate_pr_command(reviewers, branchname):
-    generate_pr_cmd = 'gh pr create %s -f --head %s --base main -b "%s"' % (reviewers, branchname, db_pr_body)
+def get_pr_body(body=None):
+    if body is not None:
+        return body
     if g_args.artifact_type == 'alert':
-        generate_pr_cmd = 'gh pr create %s -f --head %s --base main -b "%s"' % (reviewers, branchname, alert_pr_body)
+        return alert_pr_body
+    return db_pr_body
+
+def get_generate_pr_command(reviewers, branchname, body=None):
+    generate_pr_cmd = ['gh', 'pr', 'create'] + reviewers.split() + ['-f', '--head', branchname, '--base', 'main', '-b', get_pr_body(body)]
     return generate_pr_cmd
 
-def create_pr(reviewers, branchname, additional_reviewers, dbname, dryrun=False):
+def create_pr(reviewers, branchname, additional_reviewers, dbname, dryrun=False, cwd=None, body=None):
     try:
-        generate_pr_cmd = get_generate_pr_command(reviewers, branchname)
-        out = run([generate_pr_cmd], dryrun=dryrun, capture_output=True)
+        generate_pr_cmd = get_generate_pr_command(reviewers, branchname, body=body)
+        out = run_gh(generate_pr_cmd, dryrun=dryrun, capture_output=True, cwd=cwd)
         output = out.stdout.decode('utf-8').strip().split('\t')
         return output
     except subprocess.CalledProcessError as cpe:
         # XXX: failed to create PR doesn't necessarily mean it's due to an invalid reviewer
         stderrstr = cpe.stderr.decode('utf-8').strip()
         if stderrstr.find("Could not resolve to a User") != -1 and additional_reviewers is not None:
-            global invalidReviewer
-            invalidReviewer += 1
-            global     invalidReviewers
-            invalidReviewers[reviewers] = dbname
+            with summary_lock:
+                global invalidReviewer
+                invalidReviewer += 1
+                global     invalidReviewers
+                invalidReviewers[reviewers] = dbname
             reviewers_arg = ' '.join(['-r %s' % tr for tr in additional_reviewers])
             logger.info("found invalidReviewer '%s' for %s but retrying with additional reviewers: %s", reviewers, dbname, reviewers_arg)
-            return create_pr(reviewers_arg, branchname, None, dbname, dryrun)
+            return create_pr(reviewers_arg, branchname, None, dbname, dryrun, cwd=cwd, body=body)
         else:
             logger.info("failed to create pr for %s:%s (output: %s, stderr: %s, output: %s)", g_args.artifact_type, dbname, cpe.stdout, cpe.stderr, cpe.output)
             raise cpe
 
-def create_pr_if_needed(reviewers, branchname, additional_reviewers, msg, namespace, service_team, dbname, commited, dryrun=False):
-    # Check if there's already a PR on this branch. (by default this command shows only open prs)
-    check_pr_cmd = 'gh pr list --head %s --base main' % branchname
-    out = run([check_pr_cmd], capture_output=True)
-    pr_link = None
-    pr_num = None
+@timed('pr_index')
+def load_pr_index(index_file=None, ttl=None, dryrun=False):
+    '''
+    Lists all (open and closed) PRs against main once and returns them keyed by head branch name.
+    If index_file is given, the index is reused from there while it is younger than ttl seconds.
+    '''
+    if index_file is not None and os.path.exists(index_file):
+        with open(index_file) as f:
+            saved = json.load(f)
+        age = time.time() - saved['created']
+        if ttl is None or age < ttl:
+            logger.info("using pr index %s (%d prs, %ds old)", index_file, len(saved['prs']), age)
+            return saved['prs']
+        logger.info("pr index %s is %ds old, refreshing", index_file, age)
+    if g_args.github_api_url is not None:
+        owner, repo = get_github_repo()
+        prs = github_api('GET', '/repos/%s/%s/pulls?state=all&base=main&per_page=100' % (owner, repo), pages=True)
+        lines = ['%s\t%s\t%s' % (pr['number'], pr['head']['ref'], pr['state']) for pr in prs]
+    else:
+        list_prs_cmd = ['gh', 'api', '--paginate', 'repos/{owner}/{repo}/pulls?state=all&base=main&per_page=100',
+                        '--jq', '.[] | [.number, .head.ref, .state] | @tsv']
+        out = run_gh(list_prs_cmd, shell=False, capture_output=True, cwd=toplevel_dir)
+        lines = out.stdout.decode('utf-8').splitlines()
+    index = {}
+    for line in lines:
+        fields = line.split('\t')
+        if len(fields) != 3:
+            continue
+        pr_num, branchname, state = fields
+        # Several PRs can share a head branch; an open one wins over closed ones.
+        if branchname not in index or state.lower() == 'open':
+            index[branchname] = {'number': pr_num, 'state': state.lower()}
+    logger.info("indexed %d prs", len(index))
+    if index_file is not None:
+        save_pr_index(index, index_file)
+    return index
+
+def save_pr_index(index, index_file, created=None):
+    with open('%s.tmp' % index_file, 'w') as f:
+        json.dump({'created': created if created is not None else time.time(), 'prs': index}, f)
+    os.replace('%s.tmp' % index_file, index_file)
+
+def find_pr(branchname, closed=False, cwd=None):
+    '''
+    Returns the number of the open (or with closed=True, closed) PR for branchname, or None.
+    '''
+    if pr_index is not None:
+        entry = pr_index.get(branchname)
+        if entry is not None and (entry['state'] == 'closed') == closed:
+            return entry['number']
+        return None
+    check_pr_cmd = ['gh', 'pr', 'list', '--head', branchname, '--base', 'main']
+    if closed:
+        check_pr_cmd += ['-s', 'closed']
+    out = run_gh(check_pr_cmd, capture_output=True, cwd=cwd)
     if out.returncode == 0 and len(out.stdout) != 0:
-        output = out.stdout.decode('utf-8').strip().split('\t')
-        pr_num = output[0]
-        pr_status = output[-1]
+        return out.stdout.decode('utf-8').strip().split('\t')[0]
+    return None
+
+def create_pr_if_needed(reviewers, branchname, additional_reviewers, msg, namespace, service_team, dbname, commited, dryrun=False, cwd=None, body=None):
+    '''
+    body replaces the standard PR body, also on a PR that is open already.
+    '''
+    # Check if there's already a PR on this branch.
+    pr_link = None
+    pr_num = find_pr(branchname, cwd=cwd)
+    if pr_num is not None:
         pr_link = get_pr_link(pr_num)
-        logger.info('a pr on branch %s already exists and is %s: %s', branchname, pr_status, pr_link)
+        logger.info('a pr on branch %s already exists and is open: %s', branchname, pr_link)
+        if body is not None and additional_reviewers is None:
+            run_gh(['gh', 'pr', 'edit', pr_num, '--body', body], dryrun=dryrun, cwd=cwd)
     else:
-        check_pr_cmd = 'gh pr list --head %s --base main -s closed' % branchname
-        if out.returncode == 0 and len(out.stdout) != 0:
-            pr_link = get_pr_link(pr_num)
-            logger.info('a pr on branch %s already exists and is closed. will not generate a PR. %s', branchname, pr_status, pr_link)
+        closed_pr_num = find_pr(branchname, closed=True, cwd=cwd)
+        if closed_pr_num is not None:
+            pr_link = get_pr_link(closed_pr_num)
+            logger.info('a pr on branch %s already exists and is closed. will not generate a PR. %s', branchname, pr_link)
             return pr_link, False
-        output = create_pr(reviewers, branchname, additional_reviewers, dbname, dryrun)
+        output = create_pr(reviewers, branchname, additional_reviewers, dbname, dryrun, cwd=cwd, body=body)
         pr_link = output[0]
         pr_num = pr_link.split('/')[-1]
+        if pr_index is not None:
+            with summary_lock:
+                pr_index[branchname] = {'number': pr_num, 'state': 'open'}
     # Add the additional reviewers:
     if additional_reviewers is not None and pr_num is not None:
         reviewers=','.join(additional_reviewers)
-        body = db_pr_body
-        if g_args.artifact_type == 'alert':
-            body = alert_pr_body
+        body = get_pr_body(body)
         title = get_git_commit_msg('%s update' % msg, namespace, service_team, dbname)
         logger.info("adding reviewers %s to PR %s", reviewers, pr_num)
-        pr_edit_cmd='gh pr edit %s --remove-reviewer chris-leege --add-reviewer %s --title "%s" --body "%s"' % (pr_num, reviewers, title, body)
-        run([pr_edit_cmd], capture_output=True)
+        pr_edit_cmd = ['gh', 'pr', 'edit', pr_num, '--remove-reviewer', 'chris-leege', '--add-reviewer', reviewers, '--title', title, '--body', body]
+        run_gh(pr_edit_cmd, capture_output=True, cwd=cwd)
     return pr_link, True
 
+# With --github_api_url the PR stage talks to the GitHub REST api directly instead of spawning gh for every call.
+class GitHubApiError(Exception):
+    def __init__(self, method, path, status, message):
+        super().__init__('%s %s failed with %d: %s' % (method, path, status, message))
+        self.status = status
+        self.message = message
+
+_github_repo = None
+_github_token = None
+_github_link_next_re = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+def get_github_repo():
+    '''
+    Returns the (owner, repo) PRs are created in: --github_repo, or else the one origin points to.
+    '''
+    global _github_repo
+    if _github_repo is None:
+        name = g_args.github_repo
+        if name is None:
+            url = run(['git', 'remote', 'get-url', 'origin'], capture_output=True, cwd=toplevel_dir).stdout.decode('utf-8').strip()
+            m = re.search(r'[:/]([^/:]+)/([^/]+?)(?:\.git)?/?$', url)
+            assert m is not None, "can't tell the github repo from origin (%s), use --github_repo" % url
+            name = '%s/%s' % (m.group(1), m.group(2))
+        _github_repo = tuple(name.split('/', 1))
+    return _github_repo
+
+def get_github_token():
+    '''
+    Returns the token for the api: $GH_TOKEN, $GITHUB_TOKEN or $GH_ENTERPRISE_TOKEN, or else the one gh is logged in with.
+    '''
+    global _github_token
+    if _github_token is None:
+        for name in ['GH_TOKEN', 'GITHUB_TOKEN', 'GH_ENTERPRISE_TOKEN']:
+            if os.environ.get(name):
+                _github_token = os.environ[name]
+                return _github_token
+        hostname = urllib.parse.urlsplit(g_args.github_api_url).hostname
+        if hostname == 'api.github.com':
+            hostname = 'github.com'
+        out = run(['gh', 'auth', 'token', '--hostname', hostname], check=False, capture_output=True)
+        if out.returncode != 0:
+            return None
+        _github_token = out.stdout.decode('utf-8').strip()
+    return _github_token
+
+def github_api(method, path, payload=None, pages=False, retries=5, timeout=60, base_path=None):
+    '''
+    Calls the api at --github_api_url over this thread's keep-alive connection and returns the decoded response.
+    With pages=True the list responses of all pages (see the Link header) are returned concatenated.
+    Calls run within github's concurrency limit; rate limited calls pause all calls to github and are retried.
+    '''
+    url_parts = urllib.parse.urlsplit(g_args.github_api_url)
+    if base_path is None:
+        base_path = url_parts.path.rstrip('/')
+    headers = {
+        'Accept': 'application/vnd.github+json',
+        'Authorization': 'token %s' % get_github_token(),
+        'User-Agent': 'kf-converter',
+    }
+    body = None
+    if payload is not None:
+        body = json.dumps(payload).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+    results = []
+    attempt = 0
+    while path is not None:
+        logger.info("%s %s", method, path)
+        retry_delay = None
+        with endpoint_slot('github'), span('api:github'):
+            try:
+                conn = _get_http_connection(url_parts, timeout=timeout)
+                conn.request(method, base_path + path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.HTTPException, OSError) as e:
+                _drop_http_connection(url_parts)
+                if attempt >= retries:
+                    raise
+                logger.info("%s %s failed (attempt %d/%d): %s", method, path, attempt + 1, retries + 1, e)
+                retry_delay = _get_retry_delay(attempt, 1)
+        if retry_delay is not None:
+            attempt += 1
+            time.sleep(retry_delay)
+            continue
+        status = resp.status
+        try:
+            decoded = json.loads(data) if len(data) != 0 else None
+            message = decoded.get('message', '') if isinstance(decoded, dict) else ''
+        except ValueError:
+            # E.g. the html error page of a proxy in front of github.
+            decoded = None
+            message = data[:200].decode('utf-8', errors='replace')
+            if status < 400:
+                status = 502
+        if status >= 500 and attempt < retries:
+            logger.info("%s %s failed with %d (attempt %d/%d): %s", method, path, status, attempt + 1, retries + 1, message)
+            time.sleep(_get_retry_delay(attempt, 1, resp.getheader('Retry-After')))
+            attempt += 1
+            continue
+        rate_limited = status == 429 or (status == 403 and (resp.getheader('X-RateLimit-Remaining') == '0' or 'rate limit' in message.lower()))
+        if rate_limited and attempt < retries:
+            retry_after = resp.getheader('Retry-After')
+            if retry_after is None and resp.getheader('X-RateLimit-Reset') is not None:
+                retry_after = int(resp.getheader('X-RateLimit-Reset')) - time.time()
+            logger.info("rate limited by github (attempt %d/%d): %s", attempt + 1, retries + 1, message)
+            endpoint_throttled('github', _get_retry_delay(attempt, g_args.github_retry_delay, retry_after))
+            attempt += 1
+            continue
+        if status >= 400:
+            raise GitHubApiError(method, path, status, message)
+        endpoint_succeeded('github')
+        attempt = 0
+        if not pages:
+            return decoded
+        # An empty (or otherwise not a list) page ends the listing.
+        if not isinstance(decoded, list) or len(decoded) == 0:
+            break
+        results.extend(decoded)
+        m = _github_link_next_re.search(resp.getheader('Link') or '')
+        path = None
+        if m is not None:
+            next_parts = urllib.parse.urlsplit(m.group(1))
+            path = next_parts.path[len(base_path):] + ('?%s' % next_parts.query if next_parts.query else '')
+    return results
+
+def find_pr_api(branchname):
+    '''
+    Returns (number, state) of branchname's PR, an open one winning over closed ones, or None.
+    '''
+    if pr_index is not None:
+        entry = pr_index.get(branchname)
+        return (entry['number'], entry['state']) if entry is not None else None
+    owner, repo = get_github_repo()
+    query = urllib.parse.urlencode({'head': '%s:%s' % (owner, branchname), 'base': 'main', 'state': 'all'})
+    found = None
+    for pr in github_api('GET', '/repos/%s/%s/pulls?%s' % (owner, repo, query)):
+        if found is None or pr['state'] == 'open':
+            found = (str(pr['number']), pr['state'])
+    return found
+
+def request_pr_reviewers(pr_num, reviewers, fallback_reviewers, dbname):
+    '''
+    Requests reviews from all reviewers (users, or org/team) in one call. If github rejects them, the invalid
+    reviewer is counted and fallback_reviewers are requested instead. Returns whether the reviewers were valid.
+    '''
+    owner, repo = get_github_repo()
+    payload = {'reviewers': [r for r in reviewers if '/' not in r], 'team_reviewers': [r.split('/', 1)[1] for r in reviewers if '/' in r]}
+    try:
+        github_api('POST', '/repos/%s/%s/pulls/%s/requested_reviewers' % (owner, repo, pr_num), payload)
+        return True
+    except GitHubApiError as e:
+        if e.status != 422:
+            raise
+        logger.info("invalid ghe reviewer (%s) for %s", e, dbname)
+        with summary_lock:
+            global invalidReviewer
+            invalidReviewer += 1
+            invalidReviewers[','.join(reviewers)] = dbname
+    if fallback_reviewers:
+        logger.info("retrying %s with additional reviewers: %s", dbname, fallback_reviewers)
+        request_pr_reviewers(pr_num, fallback_reviewers, None, dbname)
+    return False
+
+reviewer_cache_filename = '.kf_reviewer_cache.json'
+# Reviewer login -> whether it's a github user, set by resolve_reviewers before any PR is created.
+reviewer_status = None
+
+def github_graphql(query):
+    '''
+    Runs a graphql query, over the api with --github_api_url and with 'gh api graphql' otherwise. Returns the
+    response's data and errors.
+    '''
+    if g_args.github_api_url is not None:
+        # GitHub Enterprise serves graphql at /api/graphql next to the REST api at /api/v3, github.com at /graphql.
+        base_path = re.sub(r'/v3$', '', urllib.parse.urlsplit(g_args.github_api_url).path.rstrip('/'))
+        try:
+            response = github_api('POST', '/graphql', {'query': query}, base_path=base_path)
+        except GitHubApiError as e:
+            return None, [{'type': 'HTTP_%d' % e.status, 'message': e.message}]
+    else:
+        # gh exits non-zero when the response has errors (e.g. an unknown user) but still prints it.
+        out = run_gh(['gh', 'api', 'graphql', '-f', 'query=%s' % query], check=False, capture_output=True, cwd=toplevel_dir)
+        try:
+            response = json.loads(out.stdout)
+        except ValueError:
+            return None, [{'type': 'GH_FAILED', 'message': out.stderr.decode('utf-8', 'replace').strip()}]
+    return response.get('data'), response.get('errors', [])
+
+def resolve_github_users(logins, batch_size=100):
+    '''
+    Looks up logins batch_size at a time, as aliased user() fields of one graphql query.
+    Returns login -> whether it's a github user; logins whose lookup failed for other reasons are left out.
+    '''
+    resolved = {}
+    for start in range(0, len(logins), batch_size):
+        batch = logins[start:start + batch_size]
+        query = '{ %s }' % ' '.join('u%d: user(login: %s) { login }' % (i, json.dumps(login)) for i, login in enumerate(batch))
+        data, errors = github_graphql(query)
+        failed = set()
+        for error in errors:
+            if error.get('type') != 'NOT_FOUND':
+                logger.info("failed to resolve reviewers: %s", error.get('message'))
+                # Errors without a path fail the whole query.
+                failed.update(error['path'][:1] if error.get('path') else ['u%d' % i for i in range(len(batch))])
+        for i, login in enumerate(batch):
+            alias = 'u%d' % i
+            if data is None or alias in failed:
+                continue
+            resolved[login] = data.get(alias) is not None
+    return resolved
+
+@timed('reviewers')
+def resolve_reviewers(reviewer_lists, dbnames, cache_file=None, ttl=None):
+    '''
+    Pre-flight for the PR stage: resolves every reviewer of the run (reviewer_lists are the csv's comma separated
+    reviewer columns) against github once, reusing results from cache_file that are younger than ttl seconds.
+    Reports the invalid reviewers and sets reviewer_status, which create_artifact_pr filters reviewers with.
+    Teams (org/team) aren't looked up.
+    '''
+    global reviewer_status
+    cache = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+    now = time.time()
+    owners = {}
+    for reviewer_list, dbname in zip(reviewer_lists, dbnames):
+        for login in [r.strip() for r in reviewer_list.split(',')]:
+            if login != '' and '/' not in login:
+                owners.setdefault(login, []).append(dbname)
+    stale = sorted(login for login in owners if login not in cache or (ttl is not None and now - cache[login][0] >= ttl))
+    logger.info("resolving %d reviewers (%d cached)", len(stale), len(owners) - len(stale))
+    for login, valid in resolve_github_users(stale).items():
+        cache[login] = [now, valid]
+    if cache_file is not None and len(stale) != 0:
+        with open('%s.tmp' % cache_file, 'w') as f:
+            json.dump(cache, f)
+        os.replace('%s.tmp' % cache_file, cache_file)
+    reviewer_status = {login: cache[login][1] for login in owners if login in cache}
+    invalid = sorted(login for login, valid in reviewer_status.items() if not valid)
+    logger.info("found %d invalid reviewers: %s", len(invalid), lazy_pformat({login: owners[login] for login in invalid}))
+    return reviewer_status
+
+def create_pr_if_needed_api(reviewers, branchname, additional_reviewers, msg, namespace, service_team, dbname, dryrun=False, body=None):
+    '''
+    create_pr_if_needed over the api: a new PR gets its final title, body and reviewers right away rather than
+    being edited after 'gh pr create'. Returns the PR link, whether it's open, and whether the reviewers were valid.
+    '''
+    found = find_pr_api(branchname)
+    if found is not None and found[1] == 'closed':
+        pr_link = get_pr_link(found[0])
+        logger.info('a pr on branch %s already exists and is closed. will not generate a PR. %s', branchname, pr_link)
+        return pr_link, False, True
+    if dryrun:
+        logger.info("would create or update the pr on branch %s", branchname)
+        return None, True, True
+    owner, repo = get_github_repo()
+    body_given = body is not None
+    body = get_pr_body(body)
+    title = get_git_commit_msg('%s update' % msg if additional_reviewers is not None else msg, namespace, service_team, dbname)
+    if found is None:
+        pr = github_api('POST', '/repos/%s/%s/pulls' % (owner, repo), {'title': title, 'body': body, 'head': branchname, 'base': 'main'})
+        pr_num, pr_link = str(pr['number']), pr['html_url']
+        if pr_index is not None:
+            with summary_lock:
+                pr_index[branchname] = {'number': pr_num, 'state': 'open'}
+        if additional_reviewers is not None:
+            reviewers = [r for r in reviewers if r != 'chris-leege'] + [r for r in additional_reviewers if r not in reviewers]
+    else:
+        pr_num = found[0]
+        pr_link = get_pr_link(pr_num)
+        logger.info('a pr on branch %s already exists and is open: %s', branchname, pr_link)
+        if additional_reviewers is None:
+            if body_given:
+                github_api('PATCH', '/repos/%s/%s/pulls/%s' % (owner, repo, pr_num), {'body': body})
+            return pr_link, True, True
+        github_api('PATCH', '/repos/%s/%s/pulls/%s' % (owner, repo, pr_num), {'title': title, 'body': body})
+        try:
+            github_api('DELETE', '/repos/%s/%s/pulls/%s/requested_reviewers' % (owner, repo, pr_num), {'reviewers': ['chris-leege']})
+        except (GitHubApiError, http.client.HTTPException, OSError) as e:
+            # Only a cleanup, the PR is updated regardless.
+            logger.warning("couldn't remove chris-leege from the reviewers of PR %s: %s", pr_num, e)
+        reviewers = additional_reviewers
+    logger.info("adding reviewers %s to PR %s", ','.join(reviewers), pr_num)
+    valid_reviewer = request_pr_reviewers(pr_num, reviewers, additional_reviewers, dbname)
+    return pr_link, True, valid_reviewer
+
+# The wrapper around a dashboard for importing it via the api, see write_wrapped_grafana.
+wrapped_grafana_prefix = b'{"dashboard": '
+wrapped_grafana_suffix = b', "FolderID": "CHANGE_ME_FOLDER_ID", "Overwrite": true}'
+
+def copy_file_bytes(src, dest):
+    '''
+    Appends the contents of the src file object to the dest file object, in the kernel where possible.
+    '''
+    dest.flush()
+    size = os.fstat(src.fileno()).st_size
+    offset = 0
+    for copy in [getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)]:
+        if copy is None:
+            continue
+        try:
+            while offset < size:
+                if copy is os.sendfile:
+                    copied = os.sendfile(dest.fileno(), src.fileno(), offset, size - offset)
+                else:
+                    copied = os.copy_file_range(src.fileno(), dest.fileno(), size - offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            # Not supported for these files (e.g. across filesystems on older kernels), try the next way.
+            continue
+        if offset >= size:
+            return
+        # Stopped short (some filesystems do, or src shrank meanwhile): the rest is copied by reading it.
+        break
+    src.seek(offset)
+    dest.seek(0, os.SEEK_END)
+    shutil.copyfileobj(src, dest)
+
+def write_wrapped_grafana(grafana_file, wrapped_file):
+    '''
+    Writes wrapped_file as {"dashboard": <grafana_file>, "FolderID": ..., "Overwrite": true} from the bytes of
+    grafana_file, without parsing it, if the converter didn't write one. A wrapped file written here is written
+    again only when grafana_file's hash changes; the hash is kept in the validation cache.
+    '''
+    global _validation_cache_dirty
+    cache_key = 'wrapped:%s' % os.path.abspath(wrapped_file)
+    with _validation_cache_lock:
+        cached = get_validation_cache().get(cache_key)
+    if os.path.exists(wrapped_file) and cached is None:
+        return False
+    st = os.stat(grafana_file)
+    if cached is not None and os.path.exists(wrapped_file):
+        if cached[:2] == [st.st_size, st.st_mtime_ns]:
+            return False
+        digest = hash_file(grafana_file)
+        if cached[2] == digest:
+            with _validation_cache_lock:
+                get_validation_cache()[cache_key] = [st.st_size, st.st_mtime_ns, digest]
+                _validation_cache_dirty = True
+            return False
+    else:
+        digest = hash_file(grafana_file)
+    logger.info("writing %s", wrapped_file)
+    # Replaced rather than rewritten, like the other files that may be committed.
+    with open(grafana_file, 'rb') as src, open('%s.tmp' % wrapped_file, 'wb') as dest:
+        dest.write(wrapped_grafana_prefix)
+        copy_file_bytes(src, dest)
+        dest.write(wrapped_grafana_suffix)
+    os.replace('%s.tmp' % wrapped_file, wrapped_file)
+    with _validation_cache_lock:
+        get_validation_cache()[cache_key] = [st.st_size, st.st_mtime_ns, digest]
+        _validation_cache_dirty = True
+    return True
+
 def get_filenames(dirname, artifact_name):
     if g_args.artifact_type == "dashboard":
         filenames = [
@@ -497,14 +2120,8 @@ def get_filenames(dirname, artifact_name):
             os.path.join(dirname, 'wavefront_dashboard_link_%s.txt' % artifact_name),
             ]
         # This file doesn't get generated always. If not there, then add contents containing instructions.
-        if not os.path.exists(os.path.join(dirname, '%s_dashboard_wrapped_grafana.json'%artifact_name)):
-            wrapped_content = {
-                "dashboard": json.load(open(os.path.join(dirname, '%s_grafana.json' % artifact_name), 'r')),
-                "FolderID": 'CHANGE_ME_FOLDER_ID',
-                "Overwrite": True
-            }
-            with open(os.path.join(dirname, '%s_dashboard_wrapped_grafana.json'%artifact_name), 'w') as wrapped_file:
-                json.dump(wrapped_content, wrapped_file)
+        write_wrapped_grafana(os.path.join(dirname, '%s_grafana.json' % artifact_name),
+                              os.path.join(dirname, '%s_dashboard_wrapped_grafana.json' % artifact_name))
         try:
             filenames.append(os.path.join(dirname, '%s_dashboard_wrapped_grafana.json'%artifact_name))
         except FileNotFoundError as fne:
@@ -516,8 +2133,120 @@ def get_filenames(dirname, artifact_name):
         return [os.path.join(dirname, '%s_orig.json' % artifact_name)] + files
 
 def get_converter_cmd():
-    targetinfo = '' if g_args.artifact_type == 'dashboard' else '-t %s/notificants.json' % converter_abs_dir
-    return "%s/%s_converter -c %s/conversion_settings.yaml %s" % (converter_abs_dir, g_args.artifact_type, converter_abs_dir, targetinfo)
+    targetinfo = [] if g_args.artifact_type == 'dashboard' else ['-t', '%s/notificants.json' % converter_abs_dir]
+    return ['%s/%s_converter' % (converter_abs_dir, g_args.artifact_type), '-c', get_converter_settings_file()] + targetinfo
+
+def convert_artifact(input_file, dryrun=False):
+    '''
+    Runs the converter on input_file; the converted files are written next to it.
+    Returns None on success, otherwise the failure details.
+    '''
+    converter_full_cmd = get_converter_cmd() + ['-f', input_file]
+    try:
+        run(converter_full_cmd, dryrun=dryrun)
+    except subprocess.CalledProcessError as cpe:
+        logger.error("failed to convert %s (cmd: %s)", input_file, ' '.join(converter_full_cmd))
+        try: # Running it again to capture output.
+            run(converter_full_cmd, dryrun=dryrun, capture_output=True)
+        except subprocess.CalledProcessError as cpe:
+            logger.error("failure: stderr: %s, stdout: %s: out: %s", cpe.stderr, cpe.stdout, cpe.output)
+        return traceback.format_exc()
+    return None
+
+@timed('convert', tags=path_tags)
+def stage_conversion(input_file, staging_dir, dryrun=False, store_dir=None, reuse_stored=True):
+    '''
+    Converts a copy of input_file inside staging_dir, so that conversions can run in parallel and
+    independently of whichever branch is checked out.
+    With store_dir (see get_stored_conversion_dir), the outputs stored there are linked into staging_dir
+    instead of converting again, or the outputs of the conversion are stored there.
+    Returns the failure details (None on success) and the converted files.
+    '''
+    os.makedirs(staging_dir, exist_ok=True)
+    if store_dir is not None and reuse_stored and os.path.isdir(store_dir):
+        logger.info("reusing the conversion of %s from %s", input_file, store_dir)
+        count_conversion_store(True)
+        try:
+            os.utime(store_dir)
+        except OSError:
+            pass
+        converted_files = []
+        for f in sorted(os.listdir(store_dir)):
+            converted_files.append(os.path.join(staging_dir, f))
+            link_or_copy(os.path.join(store_dir, f), converted_files[-1])
+        return None, converted_files
+    if store_dir is not None:
+        count_conversion_store(False)
+    staged_input = os.path.join(staging_dir, os.path.basename(input_file))
+    shutil.copyfile(input_file, staged_input)
+    failure = convert_artifact(staged_input, dryrun=dryrun)
+    converted_files = [os.path.join(staging_dir, f) for f in sorted(os.listdir(staging_dir)) if f != os.path.basename(input_file)]
+    if failure is None and store_dir is not None and not dryrun:
+        store_conversion(converted_files, store_dir)
+    return failure, converted_files
+
+def install_converted_files(converted_files, dirname):
+    for converted_file in converted_files:
+        dest = os.path.join(dirname, os.path.basename(converted_file))
+        logger.debug("installing converted file %s", dest)
+        shutil.move(converted_file, dest)
+
+def read_conversion_manifest(manifest):
+    '''
+    Returns the input files listed in manifest. The manifest is either a file with one input path per
+    line ('#' starts a comment, relative paths are relative to the manifest) or a directory, in which
+    case every artifact json in it that isn't itself a converter output is used.
+    '''
+    if os.path.isdir(manifest):
+        input_files = []
+        for filename in sorted(glob.glob(os.path.join(manifest, '*.json'))):
+            if filename.endswith(converter_output_suffixes):
+                continue
+            input_files.append(os.path.abspath(filename))
+        return input_files
+    input_files = []
+    manifest_dir = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest) as manifest_file:
+        for line in manifest_file.readlines():
+            if line.startswith('#') or line.strip() == '':
+                continue
+            input_files.append(os.path.join(manifest_dir, line.strip()))
+    return input_files
+
+def convert_manifest(manifest, results_file=None, dryrun=False):
+    '''
+    Batch mode: converts every input file of the manifest, --convert_workers of them in parallel, and
+    writes the per-file result to results_file (if given).
+    '''
+    input_files = read_conversion_manifest(manifest)
+    convert_workers = g_args.convert_workers or os.cpu_count() or 1
+    logger.info("converting %d %ss from %s with %d workers", len(input_files), g_args.artifact_type, manifest, convert_workers)
+    results = {}
+    futures = {}
+    with ThreadPoolExecutor(max_workers=convert_workers) as executor:
+        for input_file in input_files:
+            if not os.path.exists(input_file):
+                logger.error("not converting missing file %s", input_file)
+                continue
+            # The outputs are written next to each input file, so the conversions don't share any files.
+            futures[input_file] = executor.submit(convert_artifact, input_file, dryrun=dryrun)
+    for input_file in input_files:
+        if input_file not in futures:
+            results[input_file] = {'status': 'failed', 'error': 'file not found'}
+            continue
+        failure = futures[input_file].result()
+        if failure is None:
+            results[input_file] = {'status': 'success'}
+        else:
+            results[input_file] = {'status': 'failed', 'error': failure}
+    failed = [f for f in results if results[f]['status'] != 'success']
+    logger.info("converted %d of %d %ss", len(results) - len(failed), len(results), g_args.artifact_type)
+    logger.info("encountered following conversion failures: %s", lazy_pformat(failed))
+    if results_file is not None:
+        with open(results_file, 'w') as rf:
+            json.dump(results, rf, indent=2)
+        logger.info("wrote conversion results to %s", results_file)
+    return results
 
 def get_git_commit_msg(msg, namespace, sevice_team, dbname):
     if g_args.artifact_type == "dashboard":
@@ -526,10 +2255,10 @@ def get_git_commit_msg(msg, namespace, sevice_team, dbname):
         return '%s: %s %s for %s/%s' % (msg, g_args.artifact_type, dbname, namespace, sevice_team)
 
 def get_git_commit_cmd(msg, namespace, sevice_team, dbname):
-    return 'git commit -a -m "%s"' % get_git_commit_msg(msg, namespace, sevice_team, dbname)
+    return ['git', 'commit', '-a', '-m', get_git_commit_msg(msg, namespace, sevice_team, dbname)]
 
 def are_files_changed():
-    result = run(['git status -u no'], capture_output=True)
+    result = run(['git', 'status', '-u', 'no'], capture_output=True)
     changed = True
     output = result.stdout.decode('utf-8').strip()
     if output.find('nothing to commit') != -1:
@@ -584,35 +2313,46 @@ def git_mv_wrong_files(filenames, namespace, service_team, dirname, artifact_nam
     #                 run(([rm_cmd]))
     return moved
 
-def git_add_and_commit(filenames, msg, namespace, service_team, dbname, dirname, branchname, dryrun=False):
+def git_add_and_commit(filenames, msg, namespace, service_team, dbname, dirname, branchname, dryrun=False, cwd=None):
     git_mv_wrong_files(filenames, namespace, service_team, dirname, dbname)
-    git_add_cmd = 'git add %s' % ' '.join(['"%s"' % fn for fn in filenames])
-    run([git_add_cmd], dryrun=dryrun)
+    git_add_cmd = ['git', 'add'] + filenames
+    run(git_add_cmd, dryrun=dryrun, cwd=cwd)
     # if not are_files_changed():
     #     return False
     git_commit_cmd = get_git_commit_cmd(msg, namespace, service_team, dbname)
     try:
-        run([git_commit_cmd], capture_output=True if dryrun == False else False, dryrun=dryrun)
+        run(git_commit_cmd, capture_output=True if dryrun == False else False, dryrun=dryrun, cwd=cwd)
     except subprocess.CalledProcessError as cpe:
         logger.info("failed to commit (output: %s, stderr: %s)", cpe.stdout, cpe.stderr)
         logger.info("Continuing on git commit error")
-    git_pull_rebase_cmd = 'git pull --rebase origin main'
-    run([git_pull_rebase_cmd], dryrun=dryrun)
-    create_remote_branch_cmd = 'git push -f origin %s' % branchname
-    run([create_remote_branch_cmd], dryrun=dryrun)
+    if bulk_push_base is not None:
+        # main was fetched once for the whole run; the branch gets pushed with its batch.
+        run(['git', 'rebase', bulk_push_base], shell=False, dryrun=dryrun, cwd=cwd)
+        return True
+    git_pull_rebase_cmd = ['git', 'pull', '--rebase', 'origin', 'main']
+    # Publish workers share refs/remotes/origin/main; concurrent fetches would fail to lock it.
+    with remote_ref_lock, endpoint_slot('git_remote'):
+        run(git_pull_rebase_cmd, dryrun=dryrun, cwd=cwd)
+    create_remote_branch_cmd = ['git', 'push', '-f', 'origin', branchname]
+    with endpoint_slot('git_remote'):
+        run(create_remote_branch_cmd, dryrun=dryrun, cwd=cwd)
     return True
 
-def checkout_branch(branchname, existing=False, dryrun=False):
+def checkout_branch(branchname, existing=False, dryrun=False, cwd=None):
+    '''
+    Checks out branchname, creating it from main (whichever branch is checked out) unless existing is set.
+    Existing branches are tried first, most branches exist by the time they are committed to.
+    '''
     failed = False
     try:
-        if existing:
-            raise subprocess.CalledProcessError(returncode=-1, cmd="just want to checkout", output="just want to checkout")
-        co_cmd = 'git checkout -b %s' % branchname
-        run([co_cmd], dryrun=dryrun)
+        co_cmd = ['git', 'checkout', '-f', branchname, '--']
+        run(co_cmd, dryrun=dryrun, cwd=cwd)
     except subprocess.CalledProcessError as cpe:
+        if existing:
+            return True
         try:
-            co_cmd = 'git checkout -f %s' % branchname
-            run([co_cmd], dryrun=dryrun)
+            co_cmd = ['git', 'checkout', '-b', branchname, 'main']
+            run(co_cmd, dryrun=dryrun, cwd=cwd)
         except:
             failed = True
     return failed
@@ -629,6 +2369,236 @@ def get_branchname(namespace, service_team, dbname):
         branchname = branchname.replace(' ', '_')
     return branchname
 
+def get_publish_branchname(namespace, service_team, dbname):
+    '''
+    The branch the artifact is committed to: its own, or its group's with --group_by.
+    '''
+    if g_args.group_by is not None:
+        return get_group_branchname(namespace, service_team)
+    return get_branchname(namespace, service_team, dbname)
+
+def get_group_branchname(namespace, service_team):
+    '''
+    Branch of the artifacts of a namespace (for alerts, of a namespace/service team pair) with --group_by namespace.
+    It's under groups/, so it can't be the branch of an artifact.
+    '''
+    if g_args.artifact_type == "dashboard" or service_team == "":
+        branchname = 'groups/%s_%ss' % (namespace, g_args.artifact_type)
+    else:
+        branchname = 'groups/%s_%s_%ss' % (namespace, service_team, g_args.artifact_type)
+    return branchname.replace(' ', '_')
+
+def get_group_commit_msg(msg, items):
+    group = items[0]['namespace'] if g_args.artifact_type == "dashboard" else '%s/%s' % (items[0]['namespace'], items[0]['service_team'])
+    return '%s: %d %ss for %s' % (msg, len(items), g_args.artifact_type, group)
+
+# Converted files listed per artifact in a group PR, with the number of CHANGE_MEs to review in them.
+group_summary_suffixes = {
+    'dashboard': ['_summary.json', '_grafana.json', '_dashboard_wrapped_grafana.json'],
+    'alert': ['_pharos.yaml', '_pharos_report.json'],
+}
+# GitHub rejects PR bodies over 65536 characters.
+max_pr_body_length = 60000
+
+def get_conversion_summary(item):
+    summary = []
+    for suffix in group_summary_suffixes[g_args.artifact_type]:
+        filename = os.path.join(item['dirname'], '%s%s' % (item['dbname'], suffix))
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                summary.append('%s%s: %d CHANGE_ME' % (item['dbname'], suffix, f.read().count(b'CHANGE_ME')))
+    return ', '.join(summary) if len(summary) != 0 else 'no converted files'
+
+def get_group_pr_body(items):
+    body = get_pr_body()
+    body += '\nArtifacts in this PR (%d):' % len(items)
+    for i, item in enumerate(items):
+        line = '\n• %s (%s) - %s' % (item['dbname'], item['dblink'], item.get('conversion_summary', 'converted earlier'))
+        if len(body) + len(line) > max_pr_body_length:
+            body += '\n• ... and %d more' % (len(items) - i)
+            break
+        body += line
+    return body
+
+def get_group_item(items):
+    '''
+    The item create_artifact_pr publishes a group's PR with: the reviewers of all the group's csv rows and a body
+    listing every artifact.
+    '''
+    reviewers = []
+    for item in items:
+        for reviewer in [r.strip() for r in item['reviewers'].split(',')]:
+            if reviewer != '' and reviewer not in reviewers:
+                reviewers.append(reviewer)
+    branchname = items[0]['branchname']
+    return {'index': items[0]['index'], 'dbname': branchname[len('groups/'):], 'dblink': None, 'namespace': items[0]['namespace'],
+            'service_team': items[0]['service_team'], 'branchname': branchname, 'reviewers': ','.join(reviewers),
+            'pr_body': get_group_pr_body(items)}
+
+def squash_branch(branchname, base, msg, dryrun=False):
+    '''
+    Replaces the commits of branchname since base by one commit.
+    '''
+    run(['git', 'checkout', '-f', branchname, '--'], shell=False, dryrun=dryrun, cwd=toplevel_dir)
+    run(['git', 'reset', '--soft', base], shell=False, dryrun=dryrun, cwd=toplevel_dir)
+    run(['git', 'commit', '-m', msg], shell=False, check=False, dryrun=dryrun, cwd=toplevel_dir)
+
+def get_repo_root(dryrun=False):
+    out = run(['git', 'rev-parse', '--show-toplevel'], shell=False, capture_output=True, cwd=toplevel_dir)
+    return out.stdout.decode('utf-8').strip()
+
+@timed('worktrees')
+def setup_publish_worktrees(num_worktrees, dryrun=False):
+    '''
+    Creates (or reuses) one git worktree of the migration repo per publish worker and returns the
+    directory within each worktree that corresponds to toplevel_dir.
+    Worktrees are kept on a detached main, since main itself stays checked out in toplevel_dir.
+    '''
+    repo_root = get_repo_root()
+    worktrees_dir = g_args.worktrees_dir
+    if worktrees_dir is None:
+        worktrees_dir = os.path.join(os.path.dirname(repo_root), '%s-worktrees' % os.path.basename(repo_root))
+    run(['git', 'worktree', 'prune'], shell=False, dryrun=dryrun, cwd=repo_root)
+    toplevels = []
+    for i in range(num_worktrees):
+        worktree = os.path.join(worktrees_dir, 'worker-%d' % i)
+        if os.path.exists(os.path.join(worktree, '.git')):
+            logger.info("reusing worktree %s", worktree)
+            run(['git', 'checkout', '-f', '--detach', 'main'], shell=False, dryrun=dryrun, cwd=worktree)
+        else:
+            logger.info("creating worktree %s", worktree)
+            run(['git', 'worktree', 'add', '-f', '--detach', worktree, 'main'], shell=False, dryrun=dryrun, cwd=repo_root)
+        toplevels.append(os.path.normpath(os.path.join(worktree, os.path.relpath(toplevel_dir, repo_root))))
+    return toplevels
+
+def publish_artifact(item, converted_files, repo_dir, msg, additional_reviewers, test=False, test_reviewers=None, dryrun=False):
+    '''
+    Commits the artifact on its branch, pushes it and creates/updates its PR, using the checkout at repo_dir
+    (either toplevel_dir or a publish worktree). Returns the outcome for the run summary.
+    With --bulk_push the branch is only committed here; it is pushed (and gets its PR) with its batch.
+    '''
+    result = commit_artifact(item, converted_files, repo_dir, msg, dryrun=dryrun)
+    if result['status'] != 'committed' or g_args.bulk_push:
+        return result
+    return create_artifact_pr(item, result, msg, additional_reviewers, test=test, test_reviewers=test_reviewers, dryrun=dryrun, cwd=repo_dir)
+
+@timed('commit', tags=item_tags)
+def commit_artifact(item, converted_files, repo_dir, msg, dryrun=False):
+    i = item['index']
+    dbname = item['dbname']
+    dblink = item['dblink']
+    namespace = item['namespace']
+    service_team = item['service_team']
+    branchname = item['branchname']
+    result = {'status': 'committed', 'commited': False, 'pr_link': None, 'created': False, 'valid_reviewer': False}
+    dirname = os.path.join(repo_dir, os.path.relpath(item['dirname'], toplevel_dir))
+    logger.info("%d: checking out %s", i, branchname)
+    failed = checkout_branch(branchname, dryrun=dryrun, cwd=repo_dir)
+    if failed:
+        logger.error("falied to create branch %s. Moving on..", branchname)
+        result['status'] = 'invalid_branch'
+        return result
+    if dirname != item['dirname']:
+        # The downloaded artifact is untracked, so only the main working tree has it.
+        os.makedirs(dirname, exist_ok=True)
+        input_file = os.path.join(item['dirname'], '%s.json' % dbname)
+        if os.path.exists(input_file):
+            shutil.copyfile(input_file, os.path.join(dirname, '%s.json' % dbname))
+    install_converted_files(converted_files, dirname)
+    if g_args.skip_pr_unconditionally:
+        logger.info("%d: skipping pr update for %s unconditionally", i, dbname)
+        result['status'] = 'skipped'
+        return result
+    if not item['should_convert'] and g_args.skip_pr_if_no_change:
+        logger.info("%d: no updates needed for %s", i, dbname)
+        result['status'] = 'skipped'
+        return result
+    # This renames the files if we already converted them.
+    rename_if_necesasry(dirname=dirname, dbname=dbname, dryrun=dryrun, cwd=repo_dir, tracked=item.get('branch_files'))
+    # This creates a file with link to db in it.
+    create_dblink_file(dirname=dirname, dbname=dbname, dblink=dblink, dryrun=dryrun)
+    filenames = get_filenames(dirname, dbname)
+    result['commited'] = git_add_and_commit(filenames, msg, namespace, service_team, dbname, dirname, branchname, dryrun=dryrun, cwd=repo_dir)
+    if journal is not None and not dryrun:
+        result['commit'] = run(['git', 'rev-parse', 'HEAD'], shell=False, capture_output=True, cwd=repo_dir).stdout.decode('utf-8').strip()
+    # The branch stays checked out, the next artifact's branch starts from main anyway (see checkout_branch).
+    return result
+
+@timed('pr', tags=item_tags)
+def create_artifact_pr(item, result, msg, additional_reviewers, test=False, test_reviewers=None, dryrun=False, cwd=None):
+    dbname = item['dbname']
+    if test:
+        reviewers = list(test_reviewers)
+    else:
+        reviewers = [r.strip() for r in item['reviewers'].split(',')]
+    dropped = []
+    if reviewer_status is not None:
+        dropped = [r for r in reviewers if reviewer_status.get(r, True) is False]
+        if len(dropped) != 0:
+            logger.info("dropping invalid reviewers %s for %s", dropped, dbname)
+            with summary_lock:
+                global invalidReviewer
+                invalidReviewer += 1
+                invalidReviewers[item['reviewers']] = dbname
+            reviewers = [r for r in reviewers if r not in dropped]
+            if len(reviewers) == 0:
+                reviewers = list(additional_reviewers or [])
+    reviewers_arg = ' '.join(['-r %s' % r for r in reviewers])
+    result['status'] = 'attempted'
+    if g_args.github_api_url is not None:
+        try:
+            result['pr_link'], result['created'], result['valid_reviewer'] = create_pr_if_needed_api(
+                reviewers, item['branchname'], additional_reviewers, msg, item['namespace'], item['service_team'], dbname, dryrun=dryrun, body=item.get('pr_body'))
+            result['valid_reviewer'] = result['valid_reviewer'] and len(dropped) == 0
+        except (GitHubApiError, http.client.HTTPException, OSError) as e:
+            logger.info("failed to create pr for %s:%s (%s)", g_args.artifact_type, dbname, e)
+        return result
+    # Only create PR if needed, otherwise push is enough.
+    try:
+        result['pr_link'], result['created'] = create_pr_if_needed(reviewers_arg, item['branchname'], additional_reviewers, msg, item['namespace'], item['service_team'], dbname, result['commited'], dryrun=dryrun, cwd=cwd, body=item.get('pr_body'))
+    except subprocess.CalledProcessError as cpe:
+        logger.info("failed to create pr for %s:%s (output: %s, stderr: %s, output: %s)", g_args.artifact_type, dbname, cpe.stdout, cpe.stderr, cpe.output)
+        # XXX: failed to create PR doesn't necessarily mean it's due to an invalid reviewer
+        if cpe.stderr is not None:
+            stderrstr = cpe.stderr.decode('utf-8').strip()
+            if stderrstr.find("Could not resolve to a User") != -1:
+                logger.info("invalid ghe reviewer (%s) for %s", cpe, dbname)
+                with summary_lock:
+                    invalidReviewer += 1
+                    invalidReviewers[item['reviewers']] = dbname
+                logger.info("invalidReviewer %s for %s", item['reviewers'], dbname)
+        else:
+            result['valid_reviewer'] = len(dropped) == 0
+    return result
+
+@timed('push')
+def push_branches(branchnames, dryrun=False):
+    '''
+    Pushes all branchnames with a single 'git push'. Returns a dict of branchname -> whether its ref was updated.
+    '''
+    logger.info("pushing %d branches", len(branchnames))
+    with endpoint_slot('git_remote'):
+        out = run(['git', 'push', '--porcelain', '-f', 'origin'] + ['refs/heads/%s' % b for b in branchnames],
+                  shell=False, check=False, capture_output=not dryrun, dryrun=dryrun, cwd=toplevel_dir)
+    if out is None:
+        return {b: True for b in branchnames}
+    pushed = {b: False for b in branchnames}
+    # Porcelain output has one '<flag>\t<src>:<dst>\t<summary>' line per ref; '!' means rejected.
+    for line in out.stdout.decode('utf-8').splitlines():
+        fields = line.split('\t')
+        if len(fields) < 3 or ':' not in fields[1]:
+            continue
+        ref = fields[1].split(':')[-1]
+        branchname = ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else ref
+        if branchname in pushed:
+            pushed[branchname] = fields[0] != '!'
+            if not pushed[branchname]:
+                logger.error("failed to push %s: %s", branchname, fields[2])
+    if out.returncode != 0:
+        logger.info("git push exited with %d (stderr: %s)", out.returncode, out.stderr.decode('utf-8').strip())
+    return pushed
+
+@timed('publish_all')
 def create_prs(dblinks=[],
                dirnames=[],
                reviewers=[],
@@ -644,15 +2614,20 @@ def create_prs(dblinks=[],
                force_convert=False,
                test=False,
                test_reviewers=None,
-               additional_reviewers=None):
+               additional_reviewers=None,
+               artifacts=None,
+               streaming=False):
     '''
     Creates PR by following these steps.
-    For each db in list of dashboards:
+    The dashboards needing conversion are converted first, in parallel (see stage_conversion).
+    For each db in list of dashboards, as soon as its conversion is done:
         1. create/checkout branch with the name of <dbname>_dashboards
         2. Add all files ending with .json in that directory to the commit.
         3. rebases with current main (tot)
         4. pushes the created branch to create a remote branch.
         5. creates a PR based on diff of main and the remote branch (gh create PR)
+    Instead of the lists, artifacts can be given as an iterable of dicts (see stream_artifacts). With
+    streaming=True they are consumed while publishing, so the first PRs don't wait for the last artifacts.
     '''
     cwd = os.getcwd()
     os.chdir(toplevel_dir)
@@ -665,6 +2640,7 @@ def create_prs(dblinks=[],
     num_prs_attempted = 0
     num_processed = 0
     invalid_dashboard_names = {}
+    push_failures = {}
     if additional_reviewers is None:
         additional_reviewers = ["owen-sullivan", "vijayarajan-k"]
     else:
@@ -673,133 +2649,447 @@ def create_prs(dblinks=[],
         if msg is None:
             msg = 'TEST - DO NOT REVIEW'
     logger.info("starting PR creation (start: %s, end: %s)", start_from, end_at)
-    for i in range(len(dbnames)):
-        dbname = dbnames[i]
-        if start_from is not None:
-            if dbname != start_from:
-                logger.info("not processing %s", dbname)
+    if artifacts is None:
+        artifacts = ({'index': i, 'dbname': dbnames[i], 'dblink': dblinks[i], 'dirname': dirnames[i], 'namespace': namespaces[i],
+                      'service_team': service_teams[i], 'reviewers': reviewers[i]} for i in range(len(dbnames)))
+    # Conversion stage: decide what needs converting and start the conversions. They run in a
+    # pool in their own staging directories, so they don't need the working tree.
+    staging_root = tempfile.mkdtemp(prefix='kf-conversions-')
+    converted = queue.Queue()
+    convert_workers = g_args.convert_workers or os.cpu_count() or 1
+    executor = ThreadPoolExecutor(max_workers=convert_workers)
+    # When streaming, at most queue_size artifacts are between planning and publishing at any time.
+    in_flight = threading.BoundedSemaphore(g_args.queue_size) if streaming else None
+    stopping = threading.Event()
+    def _submit_conversion(item, input_file, staging_dir, store_dir, reuse_stored):
+        future = executor.submit(stage_conversion, input_file, staging_dir, dryrun=dryrun,
+                                 store_dir=store_dir, reuse_stored=reuse_stored)
+        future.add_done_callback(functools.partial(lambda it, f: converted.put((it, f)), item))
+    def _plan_and_convert():
+        nonlocal start_from, num_processed
+        planned = set()
+        num_planned = 0
+        num_converting = 0
+        # With --largest_first, the conversions are only started once all of them are planned.
+        deferred = [] if g_args.largest_first else None
+        logger.info("converting %ss with %d workers", g_args.artifact_type, convert_workers)
+        for artifact in artifacts:
+            if stopping.is_set():
+                break
+            i = artifact['index']
+            dbname = artifact['dbname']
+            if start_from is not None:
+                if dbname != start_from:
+                    logger.info("not processing %s", dbname)
+                    continue
+                else:
+                    # We found the dbname to start off from, let's reset start_from now
+                    # so we process everything from now on.
+                    start_from = None
+            num_processed += 1
+            dblink = artifact['dblink']
+            dirname = artifact['dirname']
+            logger.info("%d: working with %s -- dirname: %s, name: %s, link: %s, namespace: %s, reviewers:%s", i, g_args.artifact_type, dirname, dbname, dblink, artifact['namespace'], artifact['reviewers'])
+            if dbname in planned or artifact.get('duplicate'):
+                if dbname not in duplicate_artifacts:
+                    duplicate_artifacts.update({dbname: dblink})
+                continue
+            if dbname in invalidArtifactFiles:
+                logger.error("Not procesing invalid artifact %s (%s). Moving on..", dbname, invalidArtifactFiles[dbname])
                 continue
+            planned.add(dbname)
+            branchname = get_branchname(artifact['namespace'], artifact['service_team'], dbname)
+            # The journal tracks artifacts by their own branch name, also when they're published on their group's branch.
+            journal_key = branchname
+            branchname = get_publish_branchname(artifact['namespace'], artifact['service_team'], dbname)
+            honor_force_convert = True and force_convert
+            if force_convert and g_args.start_converting_from is not None and num_processed <= g_args.start_converting_from:
+                honor_force_convert = False
+            item = dict(artifact, branchname=branchname, journal_key=journal_key, journal_progress=None, journal_pr_link=None)
+            if journal is not None:
+                item['conversion_key'] = get_conversion_key(dirname, dbname)
+                if not honor_force_convert:
+                    item['journal_progress'], item['journal_pr_link'] = get_journal_progress(journal_key, item['conversion_key'])
+            if item['journal_progress'] is not None:
+                logger.info("%d: not converting %s, the journal has it %s", i, dbname, item['journal_progress'])
+                should_convert = False
             else:
-                # We found the dbname to start off from, let's reset start_from now
-                # so we process everything from now on.
-                start_from = None
-        num_processed += 1
-        dblink = dblinks[i]
-        dbfilename = '%s.json' % dbname
-        dirname = dirnames[i]
-        namespace = namespaces[i]
-        service_team = service_teams[i]
-        logger.info("%d: working with %s -- dirname: %s, name: %s, link: %s, namespace: %s, reviewers:%s", i, g_args.artifact_type, dirname, dbname, dblink, namespace, reviewers[i])
-        if dbname in prs or dbname in prs_closed:
-            if dbname not in duplicate_artifacts:
-                duplicate_artifacts.update({dbname: dblink})
-            continue
-        branchname = get_branchname(namespace, service_team, dbname)
-        logger.info("%d: checking out %s", i, branchname)
-        failed = checkout_branch(branchname)
-        if failed:
-            logger.error("falied to create branch %s. Moving on..", branchname)
-            invalid_dashboard_names.update({dbname:dblink})
-            continue
-        if dbname in invalidArtifactFiles:
-            logger.error("Not procesing invalid artifact %s (%s). Moving on..", dbname, invalidArtifactFiles[dbname])
+                item['branch_files'] = get_branch_files(branchname, dirname)
+                should_convert = check_if_conversion_needed(dirname=dirname, dbname=dbname, force_convert=honor_force_convert,
+                                                            branch_files=item['branch_files'])
+            item['should_convert'] = should_convert
+            if in_flight is not None:
+                while not in_flight.acquire(timeout=1):
+                    if stopping.is_set():
+                        break
+            num_planned += 1
+            if convert and should_convert:
+                logger.info("%d: %s converting %s in %s", i, "force" if force_convert else "", dbname, dirname)
+                num_converting += 1
+                staging_dir = os.path.join(staging_root, str(i))
+                # Hashed before converting, so the manifest describes exactly what was converted.
+                item['conversion_inputs'] = get_conversion_inputs(dirname, dbname)
+                store_dir = get_stored_conversion_dir(dbname, item['conversion_inputs']) if g_args.artifact_store is not None else None
+                conversion = (item, os.path.join(dirname, '%s.json' % dbname), staging_dir, store_dir, not honor_force_convert)
+                if deferred is not None:
+                    deferred.append(conversion)
+                else:
+                    _submit_conversion(*conversion)
+            else:
+                converted.put((item, None))
+            if end_at is not None and dbname == end_at:
+                break
+        if deferred:
+            # A huge artifact converts about as long as hundreds of small ones. Started last, it would be the
+            # tail of the run; started first, the small ones fill the other workers in the meantime.
+            deferred.sort(key=lambda conversion: os.path.getsize(conversion[1]), reverse=True)
+            logger.info("starting the conversions largest first, the largest is %s (%d bytes)",
+                        deferred[0][1], os.path.getsize(deferred[0][1]))
+            for conversion in deferred:
+                _submit_conversion(*conversion)
+        logger.info("converting %d of %d %ss", num_converting, num_planned, g_args.artifact_type)
+        # Tells the publish stage how many artifacts to expect.
+        converted.put((None, num_planned))
+    if streaming:
+        planner = threading.Thread(target=_plan_and_convert, name='plan-convert', daemon=True)
+        planner.start()
+    else:
+        _plan_and_convert()
+    # Publish stage: artifacts are committed, pushed and get their PR in the order their conversion finishes.
+    publish_workers = max(1, g_args.publish_workers)
+    if publish_workers > 1:
+        free_worktrees = queue.Queue()
+        worktrees = setup_publish_worktrees(publish_workers, dryrun=dryrun)
+        for worktree in worktrees:
+            free_worktrees.put(worktree)
+        publish_executor = ThreadPoolExecutor(max_workers=publish_workers)
+    # PRs only talk to github, so they can be created in parallel even when the commits are made one at a time.
+    pr_executor = ThreadPoolExecutor(max_workers=g_args.pr_workers) if g_args.pr_workers > 1 else None
+    if g_args.bulk_push:
+        global bulk_push_base
+        run(['git', 'fetch', 'origin', 'main'], shell=False, dryrun=dryrun, cwd=toplevel_dir)
+        bulk_push_base = 'origin/main' if dryrun else run(['git', 'rev-parse', 'origin/main'], shell=False, capture_output=True, cwd=toplevel_dir).stdout.decode('utf-8').strip()
+        logger.info("basing branches on origin/main at %s, pushing in batches of %d", bulk_push_base, g_args.push_batch_size)
+    if g_args.use_pr_index:
+        global pr_index
+        pr_index = load_pr_index(index_file=g_args.pr_index_file, ttl=g_args.pr_index_ttl)
+        pr_index_created = time.time()
+    published = []
+    pending_push = []
+    # Group branch name -> the (item, result) of the artifacts committed to it, published together at the end.
+    groups = {}
+    def _create_pr(item, result):
+        if publish_workers == 1 and pr_executor is None:
+            _merge_published(item, create_artifact_pr(item, result, msg, additional_reviewers, test=test, test_reviewers=test_reviewers, dryrun=dryrun, cwd=toplevel_dir))
+        else:
+            published.append((item, (pr_executor or publish_executor).submit(create_artifact_pr, item, result, msg, additional_reviewers,
+                                                                             test=test, test_reviewers=test_reviewers, dryrun=dryrun, cwd=toplevel_dir)))
+    def _push_pending():
+        if len(pending_push) == 0:
+            return
+        batch = list(pending_push)
+        del pending_push[:]
+        pushed = push_branches([item['branchname'] for item, _ in batch], dryrun=dryrun)
+        for item, result in batch:
+            if not pushed[item['branchname']]:
+                push_failures.update({item['dbname']: item['branchname']})
+                continue
+            if result.get('commit') is not None:
+                journal_record(item['journal_key'], 'pushed', output_hash=result['commit'], detail=item.get('conversion_key'))
+            _create_pr(item, result)
+    def _merge_published(item, result):
+        nonlocal num_prs_attempted
+        dbname = item['dbname']
+        if result['status'] == 'invalid_branch':
+            invalid_dashboard_names.update({dbname:item['dblink']})
+            return
+        if result['status'] == 'skipped':
+            prs.update({dbname: "placeholder"})
+            return
+        # With --bulk_push an artifact is merged twice, once committed and once with its PR; the PR result still
+        # carries the commit, recording it again would put 'committed' after 'pushed'.
+        if result.get('commit') is not None and (not g_args.bulk_push or result['status'] == 'committed'):
+            journal_record(item['journal_key'], 'committed', output_hash=result['commit'], detail=item.get('conversion_key'))
+            if not g_args.bulk_push:
+                journal_record(item['journal_key'], 'pushed', output_hash=result['commit'], detail=item.get('conversion_key'))
+        if result['status'] == 'committed' and g_args.group_by is not None:
+            # The converted files are only checked out until the next artifact's branch is.
+            item['conversion_summary'] = get_conversion_summary(item)
+            groups.setdefault(item['branchname'], []).append((item, result))
+            return
+        if result['status'] == 'committed':
+            pending_push.append((item, result))
+            if len(pending_push) >= g_args.push_batch_size:
+                _push_pending()
+            return
+        if result['pr_link'] is not None:
+            if result['created']:
+                prs.update({dbname: result['pr_link']})
+            else:
+                prs_closed.update({dbname: result['pr_link']})
+            if item['journal_pr_link'] is None and not dryrun:
+                journal_record(item['journal_key'], 'pr_created' if result['created'] else 'pr_closed', detail=result['pr_link'])
+                if result['created'] and additional_reviewers is not None:
+                    journal_record(item['journal_key'], 'pr_edited', detail=result['pr_link'])
+        if result['valid_reviewer']:
+            validReviewers[item['reviewers']] = True
+        logger.info("%d: validReviewers: %d", item['index'], len(validReviewers))
+        num_prs_attempted += 1
+    def _publish_groups():
+        '''
+        Pushes the group branches (squashing them first with --group_commits squash) and creates one PR per group,
+        listing all of its artifacts. Every artifact of a group is recorded with the group's PR.
+        '''
+        branchnames = sorted(groups)
+        if g_args.group_commits == 'squash':
+            for branchname in branchnames:
+                squash_branch(branchname, bulk_push_base, get_group_commit_msg(msg, [item for item, _ in groups[branchname]]), dryrun=dryrun)
+        pushed = {}
+        for start in range(0, len(branchnames), g_args.push_batch_size):
+            pushed.update(push_branches(branchnames[start:start + g_args.push_batch_size], dryrun=dryrun))
+        group_prs = []
+        for branchname in branchnames:
+            members = groups[branchname]
+            if not pushed[branchname]:
+                push_failures.update({item['dbname']: branchname for item, _ in members})
+                continue
+            for item, result in members:
+                if result.get('commit') is not None:
+                    journal_record(item['journal_key'], 'pushed', output_hash=result['commit'], detail=item.get('conversion_key'))
+            group_item = get_group_item([item for item, _ in members])
+            group_result = {'status': 'committed', 'commited': any(result['commited'] for _, result in members),
+                            'pr_link': None, 'created': False, 'valid_reviewer': False}
+            logger.info("publishing %d %ss on %s", len(members), g_args.artifact_type, branchname)
+            create = functools.partial(create_artifact_pr, group_item, group_result, msg, additional_reviewers, test=test,
+                                       test_reviewers=test_reviewers, dryrun=dryrun, cwd=toplevel_dir)
+            group_prs.append((members, pr_executor.submit(create) if pr_executor is not None else create()))
+        for members, group_pr in group_prs:
+            group_result = group_pr.result() if pr_executor is not None else group_pr
+            for item, _ in members:
+                _merge_published(item, dict(group_result))
+        logger.info("published %d groups", len(group_prs))
+    def _merge_done_published(wait=False):
+        while len(published) > 0:
+            done = [(publish_item, publish_future) for publish_item, publish_future in published if wait or publish_future.done()]
+            if len(done) == 0:
+                return
+            for publish_item, publish_future in done:
+                published.remove((publish_item, publish_future))
+                _merge_published(publish_item, publish_future.result())
+    num_expected = None
+    num_received = 0
+    while num_expected is None or num_received < num_expected:
+        item, future = converted.get()
+        if item is None:
+            num_expected = future
             continue
-        # Rename if necessary.
-        # git_mv_wrong_files(get_filenames(dirname, dbname), namespace, service_team, dirname, dbname)
-        honor_force_convert = True and force_convert
-        if force_convert and g_args.start_converting_from is not None and num_processed <= g_args.start_converting_from:
-            honor_force_convert = False
-        should_convert = check_if_conversion_needed(dirname=dirname, dbname=dbname, force_convert=honor_force_convert)
-        if (convert and should_convert):
-            logger.info("%d: %s converting %ss in %s (current dir:%s)", i, "force" if force_convert else "", g_args.artifact_type, dirname, os.getcwd())
-            converter_full_cmd = '%s -f "%s"' % (get_converter_cmd(), os.path.join(dirname, dbfilename))
+        num_received += 1
+        if in_flight is not None:
+            in_flight.release()
+        converted_files = []
+        if future is not None:
             try:
-                run([converter_full_cmd], dryrun=dryrun)
-            except subprocess.CalledProcessError as cpe:
-                logger.error("failed to convert %s (cmd: %s)", dbname, converter_full_cmd)
-                try: # Running it again to capture output.
-                    run([converter_full_cmd], dryrun=dryrun, capture_output=True)
-                except subprocess.CalledProcessError as cpe:
-                    logger.error("failure: stderr: %s, stdout: %s: out: %s", cpe.stderr, cpe.stdout, cpe.output)
-                conversion_failures.update({dbname:traceback.format_exc()})
+                failure, converted_files = future.result()
+            except Exception:
+                failure = traceback.format_exc()
+            if failure is not None:
+                conversion_failures.update({item['dbname']:failure})
                 continue
-        if g_args.skip_pr_unconditionally:
-            logger.info("%d: skipping pr update for %s unconditionally", i, dbname)
-            prs.update({dbname: "placeholder"})
+            if not dryrun and g_args.incremental_convert:
+                record_conversion(item['dirname'], item['dbname'], item['conversion_inputs'])
+                journal_record(item['journal_key'], 'converted', output_hash=item.get('conversion_key'))
+        if item['journal_progress'] in ['pr_created', 'pr_closed']:
+            logger.info("%d: the journal has %s published already (%s)", item['index'], item['dbname'], item['journal_pr_link'])
+            _merge_published(item, {'status': 'attempted', 'pr_link': item['journal_pr_link'], 'created': item['journal_progress'] == 'pr_created', 'valid_reviewer': False})
             continue
-        if not should_convert and g_args.skip_pr_if_no_change:
-            prs.update({dbname: "placeholder"})
-            logger.info("%d: no updates needed for %s", i, dbname)
+        if item['journal_progress'] == 'pushed' and g_args.group_by is not None:
+            logger.info("%d: the journal has %s pushed already", item['index'], item['dbname'])
+            groups.setdefault(item['branchname'], []).append((item, {'status': 'committed', 'commited': True, 'pr_link': None, 'created': False, 'valid_reviewer': False}))
             continue
-        # This renames the files if we already converted them.
-        rename_if_necesasry(dirname=dirname, dbname=dbname, dryrun=dryrun)
-        # This creates a file with link to db in it.
-        create_dblink_file(dirname=dirname, dbname=dbname, dblink=dblink, dryrun=dryrun)
-        filenames = get_filenames(dirname, dbname)
-        commited = git_add_and_commit(filenames, msg, namespace, service_team, dbname, dirname, branchname, dryrun=dryrun)
-        if test:
-            reviewers_arg = ' '.join(['-r %s' % tr for tr in test_reviewers])
-        else:
-            reviewers_arg = ' '.join(['-r %s' % r.strip() for r in reviewers[i].split(',')])
-        # Only create PR if needed, otherwise push is enough.
-        try:
-            pr_link, created = create_pr_if_needed(reviewers_arg, branchname, additional_reviewers, msg, namespace, service_team, dbname, commited, dryrun=dryrun)
-            if pr_link is not None:
-                if created:
-                    prs.update({dbname: pr_link})
-                else:
-                    prs_closed.update({dbname: pr_link})
-        except subprocess.CalledProcessError as cpe:
-            logger.info("failed to create pr for %s:%s (output: %s, stderr: %s, output: %s)", g_args.artifact_type, dbname, cpe.stdout, cpe.stderr, cpe.output)
-            # XXX: failed to create PR doesn't necessarily mean it's due to an invalid reviewer
-            if cpe.stderr is not None:
-                stderrstr = cpe.stderr.decode('utf-8').strip()
-                if stderrstr.find("Could not resolve to a User") != -1:
-                    logger.info("invalid ghe reviewer (%s) for %s", cpe, dbname)
-                    global invalidReviewer
-                    invalidReviewer += 1
-                    global     invalidReviewers
-                    invalidReviewers[reviewers[i]] = dbname
-                    logger.info("invalidReviewer %s for %s", reviewers[i], dbname)
+        if item['journal_progress'] == 'pushed':
+            logger.info("%d: the journal has %s pushed already", item['index'], item['dbname'])
+            _create_pr(item, {'status': 'committed', 'commited': True, 'pr_link': None, 'created': False, 'valid_reviewer': False})
+            continue
+        if publish_workers == 1 and pr_executor is not None:
+            result = commit_artifact(item, converted_files, toplevel_dir, msg, dryrun=dryrun)
+            if result['status'] == 'committed' and not g_args.bulk_push:
+                _create_pr(item, result)
             else:
-                validReviewers[reviewers[i]] = True
-        logger.info("%d: validReviewers: %s", i, validReviewers.keys())
-        num_prs_attempted += 1
-        co_main_cmd = 'git checkout main'
-        run([co_main_cmd], dryrun=dryrun)
-        if end_at is not None and dbname == end_at:
-            logger.info("stopping at given artifact")
-            break
+                _merge_published(item, result)
+            _merge_done_published()
+        elif publish_workers == 1:
+            _merge_published(item, publish_artifact(item, converted_files, toplevel_dir, msg, additional_reviewers,
+                                                    test=test, test_reviewers=test_reviewers, dryrun=dryrun))
+        else:
+            # Blocks until one of the workers has given its worktree back.
+            worktree = free_worktrees.get()
+            publish_future = publish_executor.submit(publish_artifact, item, converted_files, worktree, msg, additional_reviewers,
+                                                     test=test, test_reviewers=test_reviewers, dryrun=dryrun)
+            publish_future.add_done_callback(functools.partial(lambda wt, f: free_worktrees.put(wt), worktree))
+            published.append((item, publish_future))
+            _merge_done_published()
         if stop_on_n != 0 and num_prs_attempted >= stop_on_n:
             break
+    stopping.set()
+    if streaming:
+        planner.join()
+    _merge_done_published(wait=True)
+    if len(groups) != 0:
+        _publish_groups()
+    _push_pending()
+    _merge_done_published(wait=True)
+    if pr_executor is not None:
+        pr_executor.shutdown()
+    if publish_workers > 1:
+        publish_executor.shutdown()
+        # Releases the artifact branches the worktrees have checked out, so that the main checkout can check them out.
+        for worktree in worktrees:
+            run(['git', 'checkout', '-f', '--detach', 'main'], shell=False, dryrun=dryrun, cwd=worktree)
+    if pr_index is not None and g_args.pr_index_file is not None and not dryrun:
+        # Keep the PRs created by this run, but don't extend the index's lifetime.
+        save_pr_index(pr_index, g_args.pr_index_file, created=pr_index_created)
+    save_validation_cache()
+    save_download_validators()
+    save_conversion_manifests()
+    executor.shutdown(cancel_futures=True)
+    shutil.rmtree(staging_root, ignore_errors=True)
     checkout_branch("main", existing=True)
-    logger.info("number of invalid reviewers (non-unique): %s", invalidReviewer)
-    logger.info("number of branches with no converted files: %s", no_converted_files)
-    logger.info("number of artifacts processed: %d", num_processed)
-    logger.info("number of PRs attempted: %d", num_prs_attempted if not dryrun else 0)
-    logger.info("number of PRs created: %d", len(prs))
-    logger.info("number of PRs closed and skipped: %d", len(prs_closed))
-    logger.info("number of duplicate artifacts: %s", len(duplicate_artifacts))
-    logger.info("encoutered following duplicate artifacts: %s", pp.pformat(duplicate_artifacts))
-    logger.info("encountered %d empty db files", len(invalidArtifactFiles))
-    logger.info("encountered %d conversion failures", len(conversion_failures))
-    logger.info("encountered %d invalid db names", len(invalid_dashboard_names))
-    logger.info("encountered following empty artifact files: %s", pp.pformat(invalidArtifactFiles))
-    logger.info("encountered following failures: %s", pp.pformat(conversion_failures))
-    logger.info("encountered following invalid db names: %s", pp.pformat(invalid_dashboard_names))
-    logger.info("encountered following invalid reviewers (unique): %s", pp.pformat(invalidReviewers))
-    logger.info("following PRs are created/exists: %s", pp.pformat(prs))
-    logger.info("following PRs are closed and skipped %s", pp.pformat(prs_closed))
+    if g_args.artifact_store is not None and g_args.artifact_store_max_conversions > 0:
+        prune_conversion_store(g_args.artifact_store_max_conversions, dryrun=dryrun)
+    summary = {
+        'artifact_type': g_args.artifact_type,
+        'shards': [g_args.shard_index],
+        'shard_count': g_args.shard_count,
+        'invalid_reviewer': invalidReviewer,
+        'no_converted_files': no_converted_files,
+        'num_processed': num_processed,
+        'num_prs_attempted': num_prs_attempted if not dryrun else 0,
+        'prs': prs,
+        'prs_closed': prs_closed,
+        'duplicate_artifacts': duplicate_artifacts,
+        'invalid_artifact_files': invalidArtifactFiles,
+        'conversion_failures': conversion_failures,
+        'invalid_db_names': invalid_dashboard_names,
+        'push_failures': push_failures,
+        'invalid_reviewers': invalidReviewers,
+        'valid_reviewers': sorted(validReviewers),
+        'conversion_store_hits': conversion_store_stats['hits'],
+        'conversion_store_misses': conversion_store_stats['misses'],
+    }
+    log_run_summary(summary)
     os.chdir(cwd)
+    if g_args.summary_file is not None:
+        write_run_summary(summary, g_args.summary_file)
+
+def log_run_summary(summary):
+    logger.info("number of invalid reviewers (non-unique): %s", summary['invalid_reviewer'])
+    logger.info("number of branches with no converted files: %s", summary['no_converted_files'])
+    logger.info("number of artifacts processed: %d", summary['num_processed'])
+    logger.info("number of PRs attempted: %d", summary['num_prs_attempted'])
+    logger.info("number of PRs created: %d", len(summary['prs']))
+    logger.info("number of PRs closed and skipped: %d", len(summary['prs_closed']))
+    logger.info("number of duplicate artifacts: %s", len(summary['duplicate_artifacts']))
+    lookups = summary.get('conversion_store_hits', 0) + summary.get('conversion_store_misses', 0)
+    if lookups != 0:
+        logger.info("reused %d of %d conversions from the artifact store (%.1f%% hit rate)",
+                    summary['conversion_store_hits'], lookups, 100.0 * summary['conversion_store_hits'] / lookups)
+    logger.info("encoutered following duplicate artifacts: %s", lazy_pformat(summary['duplicate_artifacts']))
+    logger.info("encountered %d empty db files", len(summary['invalid_artifact_files']))
+    logger.info("encountered %d conversion failures", len(summary['conversion_failures']))
+    logger.info("encountered %d invalid db names", len(summary['invalid_db_names']))
+    logger.info("encountered %d push failures", len(summary['push_failures']))
+    logger.info("encountered following empty artifact files: %s", lazy_pformat(summary['invalid_artifact_files']))
+    logger.info("encountered following failures: %s", lazy_pformat(summary['conversion_failures']))
+    logger.info("encountered following invalid db names: %s", lazy_pformat(summary['invalid_db_names']))
+    logger.info("encountered following push failures: %s", lazy_pformat(summary['push_failures']))
+    logger.info("encountered following invalid reviewers (unique): %s", lazy_pformat(summary['invalid_reviewers']))
+    logger.info("following reviewers are valid: %s", lazy_pformat(summary['valid_reviewers']))
+    logger.info("following PRs are created/exists: %s", lazy_pformat(summary['prs']))
+    logger.info("following PRs are closed and skipped %s", lazy_pformat(summary['prs_closed']))
+
+def write_run_summary(summary, filename):
+    with open('%s.tmp' % filename, 'w') as f:
+        json.dump(summary, f, indent=1, sort_keys=True)
+    os.replace('%s.tmp' % filename, filename)
+    logger.info("wrote run summary to %s", filename)
+
+def merge_run_summaries(filenames):
+    '''
+    Combines the --summary_file of every shard of a wave into one summary: counts are added up, the per artifact
+    and per reviewer entries are combined. Warns about shards that are missing or were given more than once.
+    '''
+    merged = None
+    for filename in filenames:
+        with open(filename) as f:
+            summary = json.load(f)
+        if merged is None:
+            merged = dict(summary, shards=[], valid_reviewers=[])
+            for key, value in summary.items():
+                if isinstance(value, dict):
+                    merged[key] = {}
+                elif isinstance(value, int) and key != 'shard_count':
+                    merged[key] = 0
+        if (summary['artifact_type'], summary['shard_count']) != (merged['artifact_type'], merged['shard_count']):
+            logger.error("%s is a summary of %ss in %d shards, not %ss in %d shards", filename, summary['artifact_type'],
+                         summary['shard_count'], merged['artifact_type'], merged['shard_count'])
+            exit(-1)
+        for key, value in summary.items():
+            if key == 'shards':
+                merged[key] += value
+            elif isinstance(value, dict):
+                merged[key].update(value)
+            elif isinstance(value, list):
+                merged[key] = sorted(set(merged[key]) | set(value))
+            elif isinstance(value, int) and key != 'shard_count':
+                merged[key] = merged.get(key, 0) + value
+    repeated = sorted(set(i for i in merged['shards'] if merged['shards'].count(i) > 1))
+    missing = sorted(set(range(merged['shard_count'])) - set(merged['shards']))
+    if len(repeated) != 0:
+        logger.warning("shards %s were merged more than once, their counts are off", repeated)
+    if len(missing) != 0:
+        logger.warning("shards %s are missing from the summaries", missing)
+    merged['shards'] = sorted(merged['shards'])
+    return merged
+
+
+def get_reviewer_cache_file(args):
+    return args.reviewer_cache if args.reviewer_cache is not None else os.path.join(toplevel_dir, reviewer_cache_filename)
 
+def exec_steps_streaming(args):
+    '''
+    Runs the parse -> mkdir -> download -> convert -> publish stages as a pipeline: every artifact moves on
+    as soon as the previous stage is done with it.
+    '''
+    logger.info("streaming artifacts through download, conversion and PR creation")
+    if args.resolve_reviewers:
+        # The artifacts are streamed, so the csv is read once more up front for its reviewers.
+        rows = list(zip(*process_input_names())) if args.input_names is not None else list(iter_csv(filename=args.input_file))
+        resolve_reviewers([row[3] for row in rows], [row[1] for row in rows], cache_file=get_reviewer_cache_file(args), ttl=args.reviewer_cache_ttl)
+    artifacts = run_stage(functools.partial(prepare_artifact, force=args.force_download), stream_artifacts(args),
+                          max(1, args.download_concurrency), args.queue_size, 'download')
+    create_prs(artifacts=artifacts,
+               streaming=True,
+               dryrun=args.dryrun,
+               msg=args.message,
+               convert=(not args.skip_convert),
+               force_convert = args.force_convert,
+               stop_on_n=args.stop_on_n,
+               test=args.test,
+               test_reviewers=args.test_reviewers,
+               additional_reviewers=args.additional_reviewers)
 
 def exec_steps(args):
+    if args.streaming:
+        exec_steps_streaming(args)
+        return
     if args.input_names is not None:
         logger.info("processing input names")
         dblinks, dbnames, namespaces, reviewers, service_teams = process_input_names()
     else:
         logger.info("processing input file")
         dblinks, dbnames, namespaces, reviewers, service_teams = process_csv(filename=args.input_file)
+    if args.resolve_reviewers:
+        resolve_reviewers(reviewers, dbnames, cache_file=get_reviewer_cache_file(args), ttl=args.reviewer_cache_ttl)
     logger.info("making directories")
     dirnames = mkdirs(namespaces, service_teams)
     logger.info("downloading artifacts")
@@ -823,6 +3113,116 @@ def exec_steps(args):
                test_reviewers=args.test_reviewers,
                additional_reviewers=args.additional_reviewers)
 
+def percentile(values, p):
+    '''
+    Nearest-rank percentile of sorted values.
+    '''
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+def summarize_timings():
+    '''
+    Summarizes the recorded timings per stage (latency percentiles, histogram buckets and the slowest
+    artifacts) and per namespace.
+    '''
+    stages = {}
+    with timing_spans_lock:
+        for stage, stats in sorted(timing_stages.items()):
+            durations = sorted(stats['sample'])
+            cumulative = 0
+            buckets = []
+            for le, count in zip(timing_buckets, stats['buckets']):
+                cumulative += count
+                buckets.append([le, cumulative])
+            stages[stage] = {
+                'count': stats['count'],
+                'failures': stats['failures'],
+                'sum': stats['sum'],
+                'p50': percentile(durations, 50),
+                'p90': percentile(durations, 90),
+                'p99': percentile(durations, 99),
+                'max': stats['max'],
+                'buckets': buckets,
+                'slowest': [{'duration': duration, 'artifact': artifact, 'namespace': namespace}
+                            for duration, _, artifact, namespace in sorted(stats['slowest'], reverse=True)],
+            }
+        namespaces = {namespace: dict(namespace_stages) for namespace, namespace_stages in timing_namespaces.items()}
+    return {'artifact_type': g_args.artifact_type, 'stages': stages, 'namespaces': namespaces}
+
+def _prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def write_prometheus_textfile(summary, filename):
+    '''
+    Writes the stage histograms in the format of node_exporter's textfile collector.
+    '''
+    lines = ['# HELP kf_converter_stage_duration_seconds Time spent in each stage of convert_and_generate_prs.py.',
+             '# TYPE kf_converter_stage_duration_seconds histogram']
+    for stage, stats in summary['stages'].items():
+        labels = 'artifact_type="%s",stage="%s"' % (_prometheus_label(summary['artifact_type']), _prometheus_label(stage))
+        for le, count in stats['buckets']:
+            lines.append('kf_converter_stage_duration_seconds_bucket{%s,le="%s"} %d' % (labels, le, count))
+        lines.append('kf_converter_stage_duration_seconds_bucket{%s,le="+Inf"} %d' % (labels, stats['count']))
+        lines.append('kf_converter_stage_duration_seconds_sum{%s} %f' % (labels, stats['sum']))
+        lines.append('kf_converter_stage_duration_seconds_count{%s} %d' % (labels, stats['count']))
+    lines += ['# HELP kf_converter_stage_failures_total Stage spans that ended with an exception.',
+              '# TYPE kf_converter_stage_failures_total counter']
+    for stage, stats in summary['stages'].items():
+        lines.append('kf_converter_stage_failures_total{artifact_type="%s",stage="%s"} %d' % (_prometheus_label(summary['artifact_type']), _prometheus_label(stage), stats['failures']))
+    lines += ['# HELP kf_converter_last_run_timestamp_seconds When the run finished.',
+              '# TYPE kf_converter_last_run_timestamp_seconds gauge',
+              'kf_converter_last_run_timestamp_seconds{artifact_type="%s"} %f' % (_prometheus_label(summary['artifact_type']), time.time())]
+    # The collector may read at any time, so the file is only ever replaced.
+    with open('%s.tmp' % filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace('%s.tmp' % filename, filename)
+
+_profiles = []
+
+def _start_thread_profile(*args):
+    sys.setprofile(None)
+    profile = cProfile.Profile()
+    _profiles.append(profile)
+    profile.enable()
+
+def start_profiling(args):
+    if args.profile is not None:
+        # Threads started from now on get their own profile, merged when the run is done.
+        threading.setprofile(_start_thread_profile)
+        _start_thread_profile()
+    if args.tracemalloc:
+        tracemalloc.start(25)
+
+def stop_profiling(args, summary):
+    if args.profile is not None:
+        threading.setprofile(None)
+        for profile in _profiles:
+            profile.disable()
+        stats = pstats.Stats(*_profiles)
+        stats.dump_stats(args.profile)
+        logger.info("wrote profile of %d threads to %s", len(_profiles), args.profile)
+    if args.tracemalloc:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        top = snapshot.statistics('lineno')[:20]
+        logger.info("traced memory: %d bytes, peak: %d bytes", current, peak)
+        for stat in top:
+            logger.info("  %s", stat)
+        summary['tracemalloc'] = {'current': current, 'peak': peak, 'top': [str(stat) for stat in top]}
+
+def report_timings(args, summary):
+    logger.info("time spent per stage:")
+    logger.info("  %-24s %7s %10s %9s %9s %9s %9s", 'stage', 'count', 'total s', 'p50 s', 'p90 s', 'p99 s', 'max s')
+    for stage, stats in sorted(summary['stages'].items(), key=lambda item: item[1]['sum'], reverse=True):
+        logger.info("  %-24s %7d %10.2f %9.3f %9.3f %9.3f %9.3f", stage, stats['count'], stats['sum'], stats['p50'], stats['p90'], stats['p99'], stats['max'])
+    if args.timings_report is not None:
+        with open(args.timings_report, 'w') as f:
+            json.dump(summary, f, indent=1)
+        logger.info("wrote timings to %s", args.timings_report)
+    if args.prometheus_textfile is not None:
+        write_prometheus_textfile(summary, args.prometheus_textfile)
+        logger.info("wrote metrics to %s", args.prometheus_textfile)
+
 def main():
     parser = argparse.ArgumentParser(description="automate dashboard/alert download, conversion and PR generation")
     parser.add_argument('--artifact_download_url', default="https://current-provider/<artifact_type>/<artifact_name>", type=str, help="")
@@ -845,10 +3245,60 @@ def main():
     parser.add_argument('--use_cancelled_list', default=False, action="store_true", help="will not update PRs for artificats in the 'cancelled.list' file.")
     parser.add_argument('--use_approved_list', default=False, action="store_true", help="will not update the PRs in the 'approved.list' file.")
     parser.add_argument('--only_convert_new', default=False, action="store_true", help="will only convert artifacts which are not converted yet")
-    parser.add_argument('--force_download', default=False, action="store_true", help="redownload artifacts")
+    parser.add_argument('--force_download', default=False, action="store_true", help="redownload artifacts (conditionally, unchanged artifacts are left alone)")
+    parser.add_argument('--download_concurrency', default=8, type=int, help="number of artifacts downloaded in parallel")
+    parser.add_argument('--download_retries', default=3, type=int, help="number of retries for a download failing with 429/5xx or a connection error")
     parser.add_argument('--skip_pr_if_no_change', default=False, action="store_true", help="skip pr update if no change to converted file")
     parser.add_argument('--skip_pr_unconditionally', default=False, action="store_true", help="skip updating PRs unconditionally")
     parser.add_argument('--start_converting_from', default=None, type=int, help="start converting from this artifact #, until this # will force_convert doesn't have any effect")
+    parser.add_argument('--incremental_convert', default=False, action="store_true", help="also reconvert artifacts whose input, converter settings, notificants or converter version changed since they were converted")
+    parser.add_argument('--convert_workers', default=None, type=int, help="number of conversions run in parallel (default: number of cpus)")
+    parser.add_argument('--compile_config', default=None, nargs='*', help="validate the given converter settings and parser confs, or without files, the converter's own and snapshot them; once compiled, they are checked again before each run and recompiled when they change")
+    parser.add_argument('--converter_config_snapshot', default=None, help="where --compile_config writes its snapshot (default: %s in the migration repo)" % converter_config_snapshot_filename)
+    parser.add_argument('--largest_first', default=False, action="store_true", help="start the conversions of the largest artifacts first, so that huge dashboards don't become the tail of the run")
+    parser.add_argument('--github_api_url', default=None, help="create and update PRs through this GitHub REST api (e.g. https://ghe.megaleo.com/api/v3) instead of gh")
+    parser.add_argument('--github_repo', default=None, help="owner/repo to create PRs in with --github_api_url (default: origin's)")
+    parser.add_argument('--resolve_reviewers', default=False, action="store_true", help="resolve all reviewers against github before creating any PR, and leave out the invalid ones")
+    parser.add_argument('--reviewer_cache', default=None, help="where resolved reviewers are cached (default: %s in the repo)" % reviewer_cache_filename)
+    parser.add_argument('--reviewer_cache_ttl', default=86400, type=int, help="seconds a cached reviewer resolution is reused")
+    parser.add_argument('--log_file', default='automate_output.log', help="file the log is appended to")
+    parser.add_argument('--log_format', default='text', choices=['text', 'jsonl'], help="format of the log file; jsonl has one json object per line, with the stage, artifact and namespace logged from")
+    parser.add_argument('--log_level', default='DEBUG', type=str.upper, choices=log_level_names, help="level of messages logged")
+    parser.add_argument('--stage_log_level', default=None, action="append", help="level of messages logged within a stage, e.g. parse=WARNING or 'exec:git checkout=INFO'; the stage names are the ones in --timings_report")
+    parser.add_argument('--log_max_bytes', default=0, type=int, help="rotate the log file when it grows past this size")
+    parser.add_argument('--log_backup_count', default=5, type=int, help="number of rotated log files kept")
+    parser.add_argument('--async_logging', default=False, action="store_true", help="write the log from a separate thread, formatting messages there when possible")
+    parser.add_argument('--shard_index', default=0, type=int, help="with --shard_count, the shard of the csv's artifacts this run processes (0 based)")
+    parser.add_argument('--shard_count', default=1, type=int, help="split the csv's artifacts into this many shards, e.g. to run a wave on several hosts with the same csv and flags")
+    parser.add_argument('--shard_by', default='artifact', choices=['artifact', 'namespace'], help="shard by artifact name, or by the namespace of an artifact's first row to keep namespaces together")
+    parser.add_argument('--summary_file', default=None, help="write the run summary (PRs created, failures, invalid reviewers, duplicates) to this json file")
+    parser.add_argument('--merge_summaries', default=None, nargs='+', help="only combine these --summary_file files of a wave's shards into one report (written to --summary_file if given)")
+    parser.add_argument('--group_by', default=None, choices=['namespace'], help="publish the artifacts of a namespace (for alerts, of a namespace/service team pair) on one branch with one PR; implies --bulk_push")
+    parser.add_argument('--group_commits', default='artifact', choices=['artifact', 'squash'], help="with --group_by, one commit per artifact or one squashed commit per group")
+    parser.add_argument('--pr_workers', default=1, type=int, help="number of PRs created/updated in parallel; they only talk to github, so this works without --publish_workers too")
+    parser.add_argument('--artifact_api_concurrency', default=None, type=int, help="max concurrent requests to the artifact api (default: --download_concurrency); halved whenever the api throttles")
+    parser.add_argument('--github_concurrency', default=4, type=int, help="max concurrent gh calls; halved whenever github rate limits")
+    parser.add_argument('--github_retry_delay', default=60, type=float, help="seconds to pause gh calls after github rate limits, doubled on every retry")
+    parser.add_argument('--git_remote_concurrency', default=4, type=int, help="max concurrent pushes/pulls to the git remote")
+    parser.add_argument('--publish_workers', default=1, type=int, help="number of artifacts published (committed, pushed, PR'ed) in parallel, each worker in its own git worktree")
+    parser.add_argument('--artifact_store', default=None, help="content addressed store of downloaded artifacts and converter outputs, linked into the namespace directories instead of downloading or converting again")
+    parser.add_argument('--artifact_store_max_conversions', default=0, type=int, help="number of converter outputs kept in the --artifact_store, the least recently used ones are evicted at the end of a run (0 keeps all)")
+    parser.add_argument('--worktrees_dir', default=None, help="directory for the publish workers' git worktrees (default: <repo>-worktrees next to the repo)")
+    parser.add_argument('--bulk_push', default=False, action="store_true", help="fetch main once, base all branches on it and push branches in batches instead of pull/push per artifact")
+    parser.add_argument('--push_batch_size', default=100, type=int, help="number of branches pushed with one 'git push' in --bulk_push mode")
+    parser.add_argument('--use_pr_index', default=False, action="store_true", help="list all PRs once up front instead of querying gh for every artifact")
+    parser.add_argument('--pr_index_file', default=None, help="file to persist the PR index to and reuse it from")
+    parser.add_argument('--pr_index_ttl', default=3600, type=int, help="seconds a persisted PR index is reused before being refreshed")
+    parser.add_argument('--streaming', default=False, action="store_true", help="pipeline the stages: artifacts are downloaded, converted and PR'ed as the csv is read")
+    parser.add_argument('--queue_size', default=64, type=int, help="maximum number of artifacts waiting between two stages in --streaming mode")
+    parser.add_argument('--journal', default=None, help="sqlite journal of the stages each artifact completed; reruns skip what the journal has done already")
+    parser.add_argument('--journal_report', default=False, action="store_true", help="report the progress recorded in --journal and exit")
+    parser.add_argument('--timings_report', default=None, help="write the per-stage timings (percentiles, histograms, slowest artifacts, per namespace totals) as json to this file")
+    parser.add_argument('--prometheus_textfile', default=None, help="write the per-stage timing histograms to this file for the node_exporter textfile collector (*.prom)")
+    parser.add_argument('--profile', default=None, help="profile the run with cProfile (all threads) and write the pstats to this file")
+    parser.add_argument('--tracemalloc', default=False, action="store_true", help="trace python memory allocations and report the top allocation sites")
+    parser.add_argument('--convert_manifest', default=None, help="batch mode: only convert the artifacts listed in this manifest file (or all artifacts in this directory) and exit")
+    parser.add_argument('--conversion_results', default='conversion_results.json', help="file to write the per-file results of --convert_manifest to")
     parser.add_argument('-skip_checks', default=False, action="store_true", help="skip checking for critical artifacts or marked to be converted etc fields and generate as long as namespace/service is known")
     args = parser.parse_args()
     logger.debug("running command: %s", ' '.join(sys.argv))
@@ -870,7 +3320,61 @@ def main():
         logger.debug("processing input_names: %s (type)", args.input_names)
     global g_args
     g_args = args
-    exec_steps(args)
+    setup_logging(args)
+    if args.journal is not None:
+        open_journal(args.journal)
+    if args.journal_report:
+        if journal is None:
+            logger.error("--journal_report needs --journal")
+            exit(-1)
+        report_journal()
+        exit(0)
+    if args.merge_summaries is not None:
+        summary = merge_run_summaries(args.merge_summaries)
+        log_run_summary(summary)
+        if args.summary_file is not None:
+            write_run_summary(summary, args.summary_file)
+        exit(0)
+    if args.compile_config is not None:
+        if len(args.compile_config) != 0:
+            # Other files are only checked, the snapshot is of the files the converter reads.
+            snapshot = compile_converter_config(args.compile_config)
+        else:
+            snapshot = compile_converter_config(get_converter_config_files(), get_converter_config_snapshot_file(args))
+        exit(0 if snapshot is not None else -1)
+    if not args.skip_convert and os.path.exists(get_converter_config_snapshot_file(args)):
+        # Once compiled, the config is checked before every run, so a broken edit doesn't fail every conversion.
+        if get_converter_config(get_converter_config_snapshot_file(args)) is None:
+            exit(-1)
+    if not 0 <= args.shard_index < args.shard_count:
+        logger.error("--shard_index must be in [0, --shard_count)")
+        exit(-1)
+    if args.largest_first and args.streaming:
+        logger.error("--largest_first needs to see all the artifacts before converting and can't be used with --streaming")
+        exit(-1)
+    if args.group_by is not None:
+        if args.publish_workers > 1:
+            logger.error("--group_by commits a group's artifacts to one branch and can't use --publish_workers")
+            exit(-1)
+        if args.shard_count > 1 and args.shard_by != 'namespace':
+            logger.error("--group_by namespace needs --shard_by namespace, so that a group isn't split across shards")
+            exit(-1)
+        # Group branches are based on main as fetched once, and pushed together at the end.
+        args.bulk_push = True
+    setup_endpoint_limiters(args)
+    if args.github_api_url is not None and get_github_token() is None:
+        logger.error("--github_api_url needs a token: set GH_TOKEN or log in with 'gh auth login'")
+        exit(-1)
+    start_profiling(args)
+    try:
+        if args.convert_manifest is not None:
+            results = convert_manifest(args.convert_manifest, results_file=args.conversion_results, dryrun=args.dryrun)
+            exit(0 if all(r['status'] == 'success' for r in results.values()) else 1)
+        exec_steps(args)
+    finally:
+        summary = summarize_timings()
+        stop_profiling(args, summary)
+        report_timings(args, summary)
 
 if __name__ == "__main__":
     # import pdb